@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+#   loadgen.py
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain a
+#   copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#------------------------------------------------------------------------------
+
+"""
+Load generator for Miniboa.
+
+Opens many loopback connections to an echo TelnetServer, answers its
+terminal negotiation like a real client would, sends scripted lines at a
+steady rate and reports throughput, echo latency, CPU time and memory.
+
+Run from the repository root with, for example:
+
+    python benchmarks/loadgen.py --clients 1000 --rate 1 --duration 20
+
+By default the server is started in a child process; use --port to load
+a server that is already running instead.
+"""
+
+import argparse
+import heapq
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import miniboa
+
+IAC = 255
+SB = 250
+SE = 240
+WILL = 251
+WONT = 252
+DO = 253
+DONT = 254
+IS = 0
+TTYPE = 24
+NAWS = 31
+TSPEED = 32
+
+## What the simulated clients tell the server about themselves
+TERMINAL_TYPE = b'XTERM'
+TERMINAL_SPEED = b'38400,38400'
+WINDOW_SIZE = (80, 24)
+
+## Lines sent when no --script is given
+DEFAULT_SCRIPT = ('look', 'say Hello everybody!', 'who',
+    'tell someone Are you there?', 'inventory')
+
+#--[ Echo Server ]-------------------------------------------------------------
+
+def _echo_line(client, line):
+    client.send(line + "\n")
+
+def _greet(client):
+    client.detect_term_caps()
+
+def serve(conn, backend, metrics):
+    """
+    Run an echo TelnetServer until told to stop over conn, then send back
+    the CPU time and memory it used.
+    """
+    server = miniboa.TelnetServer(port=0, address='127.0.0.1',
+        on_connect=_greet, on_disconnect=lambda client: None,
+        on_command=_echo_line, backend=backend, metrics=metrics,
+        timeout=0.05)
+    conn.send(server.server_socket.getsockname()[1])
+    start = os.times()
+    while not conn.poll():
+        server.poll()
+    end = os.times()
+    stats = server.stats() if metrics else None
+    conn.send({
+        'cpu': (end.user - start.user) + (end.system - start.system),
+        'rss': rss_bytes(),
+        'stats': stats,
+        })
+
+
+def rss_bytes():
+    """
+    Return the resident set size of this process, or its peak where the
+    current one is not available.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## Kilobytes on Linux, bytes on OS X
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+#--[ Simulated Client ]--------------------------------------------------------
+
+class LoadClient(object):
+    """
+    One simulated player.  Answers TTYPE, TSPEED and NAWS, refuses every
+    other option and matches echoed lines against the ones it sent.
+    """
+    def __init__(self, index, sock, script):
+        self.index = index
+        self.sock = sock
+        self.script = script
+        self.line = index % len(script)
+        self.seq = 0
+        self.sent = {}          # Sequence number -> time sent
+        self.inbound = b''      # Unparsed bytes
+        self.text = b''         # Text of the current line
+        self.outbound = b''
+        self.connected = False
+        self.closed = False
+
+    def next_line(self, now):
+        """
+        Queue the next line of the script, tagged with a sequence number.
+        """
+        self.seq += 1
+        self.sent[self.seq] = now
+        line = '{} #{}\r\n'.format(self.script[self.line], self.seq)
+        self.line = (self.line + 1) % len(self.script)
+        self.outbound += line.encode('ascii')
+        return len(line)
+
+    def negotiate(self, data):
+        """
+        Consume telnet commands from the start of data, answering them.
+        Returns how many bytes were used, 0 if the command is incomplete.
+        """
+        if len(data) < 2:
+            return 0
+        cmd = data[1]
+        if cmd == IAC:
+            self.text += b'\xff'
+            return 2
+        if cmd in (WILL, WONT, DO, DONT):
+            if len(data) < 3:
+                return 0
+            option = data[2]
+            if cmd == DO:
+                if option in (TTYPE, TSPEED, NAWS):
+                    self.outbound += bytes((IAC, WILL, option))
+                    if option == NAWS:
+                        columns, rows = WINDOW_SIZE
+                        self.outbound += bytes((IAC, SB, NAWS, 0, columns,
+                            0, rows, IAC, SE))
+                else:
+                    self.outbound += bytes((IAC, WONT, option))
+            elif cmd == WILL:
+                self.outbound += bytes((IAC, DONT, option))
+            return 3
+        if cmd == SB:
+            end = data.find(bytes((IAC, SE)))
+            if end == -1:
+                return 0
+            option = data[2]
+            if option == TTYPE:
+                value = TERMINAL_TYPE
+            elif option == TSPEED:
+                value = TERMINAL_SPEED
+            else:
+                return end + 2
+            self.outbound += bytes((IAC, SB, option, IS)) + value + bytes((IAC, SE))
+            return end + 2
+        return 2
+
+    def receive(self, data, now, latencies):
+        """
+        Handle bytes from the server, recording the latency of each echo.
+        """
+        data = self.inbound + data
+        pos = 0
+        while pos < len(data):
+            mark = data.find(b'\xff', pos)
+            if mark == -1:
+                mark = len(data)
+            self._text(data[pos:mark], now, latencies)
+            if mark == len(data):
+                pos = mark
+                break
+            used = self.negotiate(data[mark:])
+            if not used:
+                break
+            pos = mark + used
+        self.inbound = data[pos:]
+
+    def _text(self, text, now, latencies):
+        lines = (self.text + text).split(b'\n')
+        self.text = lines.pop()
+        for line in lines:
+            tag = line.rstrip().rpartition(b' #')[2]
+            if tag.isdigit():
+                sent = self.sent.pop(int(tag), None)
+                if sent is not None:
+                    latencies.append(now - sent)
+
+#--[ Load Generator ]----------------------------------------------------------
+
+def raise_fd_limit(wanted):
+    """
+    Raise the open file limit towards wanted if we are allowed to.
+    """
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return float('nan')
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run(host, port, clients, rate, duration, ramp, script):
+    """
+    Drive the simulated clients and return a dict of results.
+    """
+    selector = selectors.DefaultSelector()
+    load = []
+    latencies = []
+    due = []                # Heap of (time, index) of the next line to send
+    totals = {'lines': 0, 'sent': 0, 'received': 0, 'failed': 0}
+    interval = 1.0 / rate if rate > 0 else None
+
+    start = time.perf_counter()
+    cpu_start = os.times()
+    connect_until = start
+    stop = start + duration
+
+    while True:
+        now = time.perf_counter()
+        if now >= stop:
+            break
+
+        ## Ramp up the connections
+        while len(load) < clients and connect_until <= now:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            sock.connect_ex((host, port))
+            client = LoadClient(len(load), sock, script)
+            load.append(client)
+            selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+            if interval is not None:
+                heapq.heappush(due, (now + random.random() * interval, client.index))
+            connect_until += 1.0 / ramp
+
+        ## Send the lines that are due
+        while due and due[0][0] <= now:
+            when, index = heapq.heappop(due)
+            client = load[index]
+            if client.closed:
+                continue
+            if client.connected:
+                client.next_line(now)
+                totals['lines'] += 1
+                _flush(selector, client, totals)
+            heapq.heappush(due, (when + interval, index))
+
+        timeout = 0.01
+        if due:
+            timeout = max(0, min(timeout, due[0][0] - now))
+        for key, events in selector.select(timeout):
+            client = key.data
+            now = time.perf_counter()
+            if events & selectors.EVENT_WRITE:
+                if not client.connected:
+                    error = client.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if error:
+                        _close(selector, client, totals)
+                        continue
+                    client.connected = True
+                _flush(selector, client, totals)
+            if events & selectors.EVENT_READ and not client.closed:
+                try:
+                    data = client.sock.recv(65536)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    data = b''
+                if not data:
+                    _close(selector, client, totals)
+                    continue
+                totals['received'] += len(data)
+                client.receive(data, now, latencies)
+                if client.outbound:
+                    _flush(selector, client, totals)
+
+    elapsed = time.perf_counter() - start
+    cpu_end = os.times()
+    connected = sum(1 for client in load if client.connected and not client.closed)
+    for client in load:
+        if not client.closed:
+            _close(selector, client, totals)
+    selector.close()
+
+    latencies.sort()
+    return {
+        'elapsed': elapsed,
+        'connected': connected,
+        'failed': totals['failed'],
+        'lines': totals['lines'],
+        'echoes': len(latencies),
+        'sent': totals['sent'],
+        'received': totals['received'],
+        'p50': percentile(latencies, 0.50),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else float('nan'),
+        'cpu': ((cpu_end.user - cpu_start.user) +
+            (cpu_end.system - cpu_start.system)),
+        'rss': rss_bytes(),
+        }
+
+
+def _flush(selector, client, totals):
+    """
+    Send what we can of a client's output, watching for writability only
+    while some is left over.
+    """
+    if client.outbound:
+        try:
+            sent = client.sock.send(client.outbound)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            _close(selector, client, totals)
+            return
+        totals['sent'] += sent
+        client.outbound = client.outbound[sent:]
+    events = selectors.EVENT_READ
+    if client.outbound:
+        events |= selectors.EVENT_WRITE
+    selector.modify(client.sock, events, client)
+
+
+def _close(selector, client, totals):
+    if not client.connected:
+        totals['failed'] += 1
+    client.closed = True
+    selector.unregister(client.sock)
+    client.sock.close()
+
+#--[ Main ]--------------------------------------------------------------------
+
+def report(results, server):
+    elapsed = results['elapsed']
+    print("{:<20} {} connected, {} failed".format('connections',
+        results['connected'], results['failed']))
+    print("{:<20} {:.1f} s".format('duration', elapsed))
+    print("{:<20} {} sent, {} echoed".format('lines', results['lines'],
+        results['echoes']))
+    print("{:<20} {:.0f} lines/s, {:.1f} KB/s out, {:.1f} KB/s in".format(
+        'throughput', results['echoes'] / elapsed,
+        results['sent'] / elapsed / 1024, results['received'] / elapsed / 1024))
+    print("{:<20} p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+        'echo latency', results['p50'] * 1e3, results['p99'] * 1e3,
+        results['max'] * 1e3))
+    print("{:<20} {:.2f} s cpu ({:.0f}%), {} rss".format('loadgen',
+        results['cpu'], 100 * results['cpu'] / elapsed, megabytes(results['rss'])))
+    if server is not None:
+        print("{:<20} {:.2f} s cpu ({:.0f}%), {} rss".format('server',
+            server['cpu'], 100 * server['cpu'] / elapsed, megabytes(server['rss'])))
+        stats = server['stats']
+        if stats is not None:
+            poll = stats['poll_seconds']
+            print("{:<20} {} polls, p50 {} ready sockets, p99 poll time {} ms".format(
+                'server metrics', stats['polls'], stats['ready_sockets']['p50'],
+                poll['p99'] * 1e3 if poll['p99'] is not None else 'over 1000'))
+
+
+def megabytes(size):
+    if size is None:
+        return 'unknown'
+    return "{:.1f} MB".format(size / 1048576)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test a Miniboa server.")
+    parser.add_argument('--clients', type=int, default=500,
+        help="number of connections to open")
+    parser.add_argument('--rate', type=float, default=1.0,
+        help="lines per second sent by each client")
+    parser.add_argument('--duration', type=float, default=10.0,
+        help="seconds to run for, including the ramp up")
+    parser.add_argument('--ramp', type=float, default=500.0,
+        help="new connections per second")
+    parser.add_argument('--script',
+        help="file with the lines to send, one per line, sent in a loop")
+    parser.add_argument('--host', default='127.0.0.1',
+        help="host of an already running server, used with --port")
+    parser.add_argument('--port', type=int,
+        help="load an already running server instead of starting one")
+    parser.add_argument('--backend', choices=sorted(miniboa.BACKENDS),
+        help="polling backend of the server we start")
+    parser.add_argument('--metrics', action='store_true',
+        help="enable and report the metrics of the server we start")
+    args = parser.parse_args(argv)
+
+    script = DEFAULT_SCRIPT
+    if args.script:
+        with open(args.script) as lines:
+            script = [line.rstrip('\n') for line in lines if line.strip()]
+
+    ## Both ends of every connection are in this host's file table
+    raise_fd_limit(args.clients * 2 + 64)
+
+    child = None
+    port = args.port
+    if port is None:
+        conn, child_conn = multiprocessing.Pipe()
+        child = multiprocessing.Process(target=serve,
+            args=(child_conn, args.backend, args.metrics))
+        child.start()
+        port = conn.recv()
+
+    results = run(args.host, port, args.clients, args.rate, args.duration,
+        args.ramp, script)
+
+    server = None
+    if child is not None:
+        conn.send('stop')
+        server = conn.recv()
+        child.join()
+
+    report(results, server)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,553 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+#   micro.py
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain a
+#   copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#------------------------------------------------------------------------------
+
+"""
+Micro-benchmarks for the hot paths in Miniboa.
+
+Run from the repository root with:  python benchmarks/micro.py
+
+Timings depend on the machine, so baselines are kept per checkout: record
+one with --save before a change, then run with --compare afterwards to
+have every benchmark more than --threshold times slower reported and the
+script exit with an error.
+
+Every run first checks that word_wrap() still wraps plain text exactly as
+the original implementation did, and exits with an error if not.  Use
+--check to run only that, without timing anything.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import miniboa
+from miniboa import TelnetClient, colorize
+
+REPEAT = 7
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+THRESHOLD = 1.25        # Slowdown reported as a regression
+
+#--[ Sample Traffic ]----------------------------------------------------------
+
+## A paste flood: lots of plain text with the odd NAWS report in between
+PASTE = (b"say The quick brown fox jumps over the lazy dog.\r\n" * 40 +
+    b"\xff\xfa\x1f\x00\x50\x00\x19\xff\xf0") * 25
+
+
+## What a typical client answers to detect_term_caps()
+NEGOTIATION = (b"\xff\xfb\x18\xff\xfb\x20\xff\xfb\x1f"
+    b"\xff\xfa\x1f\x00\x50\x00\x18\xff\xf0"
+    b"\xff\xfa\x18\x00XTERM\xff\xf0"
+    b"\xff\xfa\x20\x0038400,38400\xff\xf0")
+
+## A room description as a MUD would send it
+ROOM = ("^G[^YThe Town Square^G]^d\n"
+    "^wYou are standing in the ^Wcentre^w of a bustling square.  A ^Cfountain^w "
+    "splashes to the ^Rnorth^w and ^ymerchants^w hawk their wares from stalls "
+    "all around.  ^K(^dExits: ^Rnorth^d, ^Rsouth^d, ^Reast^d, ^Rwest^K)^d\n") * 4
+
+## A help page: a few long paragraphs of plain text
+HELP = ("Movement is done by typing the name of a direction, such as north "
+    "or n, south or s, east or e, west or w, up or u and down or d.  Some "
+    "exits are hidden and have to be searched for, others are locked and "
+    "need the right key.  Type exits to list the ones you can see.\n\n") * 12
+
+## A long help page, also on disk for send_file() while main() runs
+HELP_PAGE = ("^Y" + HELP + "^d") * 40
+HELP_FILE = None
+
+## 64 KB of binary data, one byte in 256 an IAC
+BLOB = bytes(range(256)) * 256
+
+## Chat traffic as received, split the way recv() might hand it to us
+CHAT = PASTE.replace(b"\xff\xfa\x1f\x00\x50\x00\x19\xff\xf0", b"")
+CHAT_CHUNKS = [CHAT[i:i + 2048] for i in range(0, len(CHAT), 2048)]
+
+
+class NullSocket(object):
+    """
+    Stands in for a real socket so clients can be driven without a network.
+    """
+    def fileno(self):
+        return -1
+
+
+def new_client():
+    """
+    Return a TelnetClient that is not attached to a real connection.
+    """
+    return TelnetClient(NullSocket(), ('127.0.0.1', 0))
+
+
+def new_room(count=300):
+    """
+    Return count clients spread over a few terminal profiles.
+    """
+    clients = []
+    for i in range(count):
+        client = new_client()
+        client.use_ansi = i % 4 != 0
+        client.columns = (80, 80, 100, 132)[i % 4]
+        clients.append(client)
+    return clients
+
+ROOM_CLIENTS = new_room()
+
+#--[ Original Parser ]---------------------------------------------------------
+
+class OriginalParser(object):
+    """
+    The per-character input path that _iac_parse() replaced, kept as the
+    reference it is timed against.  Only the parts the sample traffic
+    reaches are copied: the state machine, the two-byte commands and NAWS.
+    """
+    def __init__(self):
+        self.recv_buffer = ''
+        self.command_list = []
+        self.cmd_ready = False
+        self.telnet_got_iac = False
+        self.telnet_got_cmd = None
+        self.telnet_got_sb = False
+        self.telnet_sb_buffer = ''
+        self.columns = 80
+        self.rows = 24
+
+    def receive(self, data):
+        """
+        What socket_recv() did with each recv(): decode, sniff every
+        character, then cut the buffer into lines.
+        """
+        for byte in str(data, "cp1252"):
+            self._iac_sniffer(byte)
+
+        while True:
+            mark = self.recv_buffer.find('\n')
+            if mark == -1:
+                break
+            cmd = self.recv_buffer[:mark].strip()
+            self.command_list.append(cmd)
+            self.cmd_ready = True
+            self.recv_buffer = self.recv_buffer[mark+1:]
+
+    def _recv_byte(self, byte):
+        self.recv_buffer += byte
+
+    def _iac_sniffer(self, byte):
+        if self.telnet_got_iac is False:
+            if byte == miniboa.IAC:
+                self.telnet_got_iac = True
+                return
+            elif self.telnet_got_sb is True:
+                if len(self.telnet_sb_buffer) < 64:
+                    self.telnet_sb_buffer += byte
+                else:
+                    self.telnet_got_sb = False
+                    self.telnet_sb_buffer = ""
+                return
+            else:
+                self._recv_byte(byte)
+                return
+        else:
+            if byte == miniboa.IAC and self.telnet_got_sb is True:
+                self.telnet_sb_buffer += byte
+                self.telnet_got_iac = False
+                return
+            elif self.telnet_got_cmd:
+                ## The sample traffic has no three byte commands
+                self.telnet_got_iac = False
+                self.telnet_got_cmd = None
+                return
+            else:
+                if byte in (miniboa.DO, miniboa.DONT, miniboa.WILL, miniboa.WONT):
+                    self.telnet_got_cmd = byte
+                    return
+                else:
+                    self._two_byte_cmd(byte)
+
+    def _two_byte_cmd(self, cmd):
+        if cmd == miniboa.SB:
+            self.telnet_got_sb = True
+            self.telnet_sb_buffer = ''
+        elif cmd == miniboa.SE:
+            self.telnet_got_sb = False
+            self._sb_decoder()
+        self.telnet_got_iac = False
+        self.telnet_got_cmd = None
+
+    def _sb_decoder(self):
+        bloc = self.telnet_sb_buffer
+        if len(bloc) > 2 and bloc[0] == miniboa.NAWS and len(bloc) == 5:
+            self.columns = (256 * ord(bloc[1])) + ord(bloc[2])
+            self.rows = (256 * ord(bloc[3])) + ord(bloc[4])
+        self.telnet_sb_buffer = ''
+
+#--[ Benchmarks ]--------------------------------------------------------------
+
+def bench_iac_sniffer():
+    """
+    The original per-character path: decode, then one call per character.
+    """
+    OriginalParser().receive(PASTE)
+
+
+def bench_iac_parse():
+    """
+    The bulk bytes parser.
+    """
+    client = new_client()
+    client._iac_parse(PASTE)
+
+
+def bench_colorize():
+    """
+    Translate a room description, bypassing the render cache.
+    """
+    miniboa._render_caret_codes(ROOM, True)
+
+
+def bench_colorize_cached():
+    """
+    Translate a room description that is already in the render cache.
+    """
+    colorize(ROOM, True)
+
+
+def bench_strip_caret_codes():
+    """
+    Strip the codes from a room description, bypassing the render cache.
+    """
+    miniboa._render_caret_codes(ROOM, False)
+
+
+def bench_word_wrap(columns):
+    """
+    Return a benchmark wrapping the help page to columns.
+    """
+    def bench():
+        miniboa.word_wrap(HELP, columns)
+    return bench
+
+
+def bench_send_wrapped():
+    """
+    Send a room description to everyone in a crowded room, one at a time.
+    """
+    for client in ROOM_CLIENTS:
+        client.send_wrapped(ROOM)
+        client.discard_output()
+
+
+def bench_message():
+    """
+    The same through a Message, rendered once per terminal profile.
+    """
+    message = miniboa.Message(ROOM, wrap=True)
+    for client in ROOM_CLIENTS:
+        client.send_message(message)
+        client.discard_output()
+
+
+def bench_send_cc_page():
+    """
+    Send a long help page as a string.
+    """
+    client = ROOM_CLIENTS[1]
+    client.send_cc(HELP_PAGE)
+    client.discard_output()
+
+
+def bench_send_file():
+    """
+    Send the same page with send_file(), after the first time a stat()
+    and a memoryview.
+    """
+    client = ROOM_CLIENTS[1]
+    client.send_file(HELP_FILE)
+    client.discard_output()
+
+
+def bench_send_text():
+    """
+    Queue a help page with send(): LF translation, encoding and escaping.
+    """
+    client = ROOM_CLIENTS[0]
+    client.send(HELP_PAGE)
+    client.discard_output()
+
+
+def bench_send_unescaped():
+    """
+    The send() path from before IAC escaping, as a reference for the cost
+    of the extra scan.
+    """
+    client = ROOM_CLIENTS[0]
+    client._send_bytes(HELP_PAGE.replace('\n', '\r\n').encode(client.encoding,
+        'replace'))
+    client.discard_output()
+
+
+def bench_escape_per_byte():
+    """
+    Doubling IAC bytes one byte at a time, for comparison.
+    """
+    out = bytearray()
+    for byte in BLOB:
+        out.append(byte)
+        if byte == 255:
+            out.append(255)
+    bytes(out)
+
+
+def bench_escape_iac():
+    """
+    Doubling IAC bytes over the whole buffer at once.
+    """
+    miniboa.escape_iac(BLOB)
+
+
+def bench_send_binary():
+    """
+    Queue binary data with send_binary().
+    """
+    client = ROOM_CLIENTS[0]
+    client.send_binary(BLOB)
+    client.discard_output()
+
+
+def bench_line_framing():
+    """
+    Split received text into lines, without any telnet commands to parse.
+    """
+    client = new_client()
+    client.max_commands = len(CHAT)
+    for chunk in CHAT_CHUNKS:
+        client._recv_text(str(chunk, "cp1252"))
+
+
+def bench_feed():
+    """
+    The whole receive path, from recv()-sized chunks to queued lines.
+    """
+    client = new_client()
+    client.max_commands = len(CHAT)
+    for chunk in CHAT_CHUNKS:
+        client.feed(chunk)
+
+
+BENCHMARKS = (
+    ('iac_sniffer (per char)', bench_iac_sniffer),
+    ('iac_parse (bulk)', bench_iac_parse),
+    ('colorize', bench_colorize),
+    ('colorize (cached)', bench_colorize_cached),
+    ('strip_caret_codes', bench_strip_caret_codes),
+    ('word_wrap (40 columns)', bench_word_wrap(40)),
+    ('word_wrap (80 columns)', bench_word_wrap(80)),
+    ('word_wrap (132 columns)', bench_word_wrap(132)),
+    ('send_wrapped (300 clients)', bench_send_wrapped),
+    ('Message (300 clients)', bench_message),
+    ('send_cc (help page)', bench_send_cc_page),
+    ('send_file (help page)', bench_send_file),
+    ('send (help page)', bench_send_text),
+    ('send, unescaped (help page)', bench_send_unescaped),
+    ('escape IAC (per byte)', bench_escape_per_byte),
+    ('escape_iac (bulk)', bench_escape_iac),
+    ('send_binary (64 KB)', bench_send_binary),
+    ('line framing', bench_line_framing),
+    ('feed (chunked)', bench_feed),
+    )
+
+def memory_per_client(count=2000):
+    """
+    Return the bytes allocated per connected and negotiated client.
+    """
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    clients = []
+    for i in range(count):
+        client = new_client()
+        client.request_terminal_type()
+        client.request_terminal_speed()
+        client.request_naws()
+        client.feed(NEGOTIATION)
+        client.discard_output()
+        clients.append(client)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return total // count
+
+#--[ Correctness ]-------------------------------------------------------------
+
+## The word_wrap() that iter_wrap() replaced, kept as the reference for text
+## without colour codes
+REFERENCE_PARA_BREAK = re.compile(r"(\n\s*\n)", re.MULTILINE)
+
+def reference_word_wrap(text, columns=80, indent=4, padding=2):
+    """
+    Given a block of text, breaks into a list of lines wrapped to
+    length.
+    """
+    paragraphs = REFERENCE_PARA_BREAK.split(text)
+    lines = []
+    columns -= padding
+    for para in paragraphs:
+        if para.isspace():
+            continue
+        line = ' ' * indent
+        for word in para.split():
+            if (len(line) + 1 + len(word)) > columns:
+                lines.append(line)
+                line = ' ' * padding
+                line += word
+            else:
+                line += ' ' + word
+        if not line.isspace():
+            lines.append(line)
+    return lines
+
+
+## Awkward cases: long words, odd whitespace and paragraph breaks
+WRAP_TEXTS = [HELP, '', ' ', '\n\n', 'word', 'x' * 200,
+    'a\n \n\tb  c\n\n\n\nd', '  leading and trailing  \n',
+    'supercalifragilisticexpialidocious ' * 10 + '\n\n' + 'a b ' * 50]
+
+def random_text(rng, words=120):
+    """
+    Return plain text of random words, spaces and paragraph breaks.
+    """
+    parts = []
+    for i in range(words):
+        parts.append('w' * rng.randint(1, 30))
+        parts.append(rng.choice((' ', ' ', ' ', '  ', '\t', '\n', '\n\n',
+            '\n \n', ' \n\n\n')))
+    return ''.join(parts)
+
+
+def check_word_wrap(count=200):
+    """
+    Compare word_wrap() with the reference on fixed and random texts over
+    a range of widths, indents and paddings.  Returns the arguments of the
+    calls that disagree.
+    """
+    rng = random.Random(1)
+    texts = WRAP_TEXTS + [random_text(rng) for i in range(count)]
+    failures = []
+    for text in texts:
+        for columns in (1, 10, 20, 40, 80, 132):
+            for indent in (0, 2, 4):
+                for padding in (0, 2, 5):
+                    args = (text, columns, indent, padding)
+                    if miniboa.word_wrap(*args) != reference_word_wrap(*args):
+                        failures.append(args)
+    return failures
+
+#--[ Main ]--------------------------------------------------------------------
+
+def run(name, func, number=20):
+    """
+    Time func and return the best time per call in seconds.
+    """
+    return min(timeit.repeat(func, number=number, repeat=REPEAT)) / number
+
+
+def compare(results, baseline, threshold):
+    """
+    Print each result next to its baseline and return the names of those
+    that got more than threshold times worse.
+    """
+    regressions = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        if not base:
+            print("{:<32} {:>12}".format(name, 'no baseline'))
+            continue
+        ratio = value / base
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print("{:<32} {:>12.3f}x{}".format(name, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Miniboa micro-benchmarks.")
+    parser.add_argument('--save', nargs='?', const=BASELINE, metavar='FILE',
+        help="store the results as the baseline")
+    parser.add_argument('--compare', nargs='?', const=BASELINE, metavar='FILE',
+        help="compare the results with a stored baseline")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+        help="slowdown over the baseline counted as a regression")
+    parser.add_argument('--check', action='store_true',
+        help="only check word_wrap against the reference, without timing")
+    args = parser.parse_args(argv)
+
+    failures = check_word_wrap()
+    if failures:
+        for text, columns, indent, padding in failures[:10]:
+            print("word_wrap({!r:.40}, {}, {}, {}) differs from the "
+                "reference".format(text, columns, indent, padding))
+        print("\n{} word_wrap mismatch(es)".format(len(failures)))
+        return 1
+    if args.check:
+        print("word_wrap matches the reference")
+        return 0
+
+    global HELP_FILE
+    handle, HELP_FILE = tempfile.mkstemp(prefix='miniboa-bench-', suffix='.txt')
+    with open(handle, 'w', encoding='utf-8') as page:
+        page.write(HELP_PAGE)
+
+    ## Seconds per call, and bytes for the memory figure
+    results = {}
+    try:
+        for name, func in BENCHMARKS:
+            best = results[name] = run(name, func)
+            print("{:<32} {:>10.1f} us".format(name, best * 1e6))
+    finally:
+        ## Along with its renderings in the file cache
+        real_path = os.path.realpath(HELP_FILE)
+        for key, cached in list(miniboa._rendered_files.items()):
+            if key[0] == real_path:
+                os.remove(cached[3])
+                del miniboa._rendered_files[key]
+        os.remove(HELP_FILE)
+    memory = results['memory per client'] = memory_per_client()
+    print("{:<32} {:>10d} bytes".format('memory per client', memory))
+
+    if args.save:
+        with open(args.save, 'w') as baseline:
+            json.dump(results, baseline, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            baseline = json.load(baseline)
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\n{} regression(s) over {:.2f}x".format(len(regressions),
+                args.threshold))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,7 +16,7 @@
 Chat Room Demo for Miniboa.
 """
 
-from miniboa import TelnetServer, AUTOSENSING
+from miniboa import TelnetServer
 
 IDLE_TIMEOUT = 300
 CLIENT_LIST = []
@@ -45,54 +45,52 @@ def on_disconnect(client):
     broadcast('^R%s ^Yleaves the Server.\n^d' % client.addrport() )
 
 
-def kick_idle():
+def on_idle(client):
     """
-    Looks for idle clients and disconnects them by setting active to False.
+    Sample on_idle function.
+    Called by the server's timers for clients that stopped typing and
+    disconnects them by setting active to False.
     """
-    ## Who hasn't been typing?
-    for client in CLIENT_LIST:
-        if client.idle() > IDLE_TIMEOUT:
-            print('-- Kicking idle client from %s' % client.addrport())
-            broadcast("^YKicked ^R%s's ^Yass out for being idle too long!\n^d" % client.addrport())
-            client.active = False
+    print('-- Kicking idle client from %s' % client.addrport())
+    broadcast("^YKicked ^R%s's ^Yass out for being idle too long!\n^d" % client.addrport())
+    client.active = False
 
 
-def process_clients():
+def on_command(client, msg):
     """
-    Check each client, if client.cmd_ready == True then there is a line of
-    input available via client.get_command().
+    Sample on_command function.
+    Called with each line of input a client sends.
     """
-    
-    for client in CLIENT_LIST:
-        if(client.client_state == AUTOSENSING):
-            client.check_auto_sense()
-            return        
-        if client.active and client.cmd_ready:
-            ## If the client sends input echo it to the chat room
-            chat(client)
+    if client.active:
+        ## If the client sends input echo it to the chat room
+        chat(client, msg)
+
+
+def on_resize(client):
+    """
+    Sample on_resize function.
+    Called when a client reports a new window size.
+    """
+    print("%s resized to %s x %s" % (client.addrport(), client.columns, client.rows))
 
 
 def broadcast(msg):
     """
     Send msg to every client.
     """
-    for client in CLIENT_LIST:
-        client.send_cc(msg)
+    telnet_server.broadcast(msg, CLIENT_LIST)
 
 
-def chat(client):
+def chat(client, msg):
     """
     Echo whatever client types to everyone.
     """
     global SERVER_RUN
-    msg = client.get_command()
     #print('^R%s says, ^B"%s"^d' % (client.addrport(), msg))
 
-    for guest in CLIENT_LIST:
-        if guest != client:
-            guest.send_cc('^R%s says,^Y %s\n^d' % (client.addrport(), msg))
-        else:
-            guest.send_cc('^RYou say,^Y %s\n^d' % msg)
+    telnet_server.broadcast('^R%s says,^Y %s\n^d' % (client.addrport(), msg),
+        CLIENT_LIST, lambda guest: guest != client)
+    client.send_cc('^RYou say,^Y %s\n^d' % msg)
 
     cmd = msg.lower()
     ## bye = disconnect
@@ -128,11 +126,12 @@ def dostat(client):
     client.send_cc("^YTerminal Speed:^R %s\n^d" % (client.terminal_speed))
     client.send_cc("^YWindow Size:^R %s x %s\n^d" % (client.columns, client.rows))
     client.send_cc("\n^G**************** ^YTelnet Options ^G****************^d\n")
-    if len(client.telnet_opt_dict) < 1:
+    opt_dict = client.telnet_opt_dict
+    if len(opt_dict) < 1:
         client.send_cc("^YNo Telnet Options Requested or Set^d\n")
-    for key in client.telnet_opt_dict:
-        client.send_cc("^YClient:^R %s ^YValue: ^R%s\n^d" % (client.telnet_opt_dict[key].option_text, client.telnet_opt_dict[key].remote_option))
-        client.send_cc("^YServer:^R %s ^YValue: ^R%s\n^d" % (client.telnet_opt_dict[key].option_text, client.telnet_opt_dict[key].local_option))
+    for key in opt_dict:
+        client.send_cc("^YClient:^R %s ^YValue: ^R%s\n^d" % (opt_dict[key].option_text, opt_dict[key].remote_option))
+        client.send_cc("^YServer:^R %s ^YValue: ^R%s\n^d" % (opt_dict[key].option_text, opt_dict[key].local_option))
     client.send_cc("\n^G****************************************************^d\n")
         
 def dohelp(client):
@@ -155,15 +154,21 @@ if __name__ == '__main__':
     ## async and telnet modules.
 
     ## Create a telnet server with a port, address,
-    ## a function to call with new connections
-    ## and one to call with lost connections.
+    ## a function to call with new connections,
+    ## one to call with lost connections,
+    ## one to call with idle connections
+    ## and ones to call with client input and window size changes.
 
     telnet_server = TelnetServer(
         port=7777,
         address='',
         on_connect=on_connect,
         on_disconnect=on_disconnect,
-        timeout = .05
+        timeout = .05,
+        idle_timeout=IDLE_TIMEOUT,
+        on_idle=on_idle,
+        on_command=on_command,
+        on_resize=on_resize
         )
 
     print(">> Listening for connections on port %d.  CTRL-C to break."
@@ -171,8 +176,7 @@ if __name__ == '__main__':
 
     ## Server Loop
     while SERVER_RUN:
-        telnet_server.poll()        ## Send, Recv, and look for new connections
-        kick_idle()                 ## Check for idle clients
-        process_clients()           ## Check for client input
+        telnet_server.poll()        ## Send, Recv, new connections, idle kicks
+                                    ## and client input
 
     print(">> Server shutdown.")
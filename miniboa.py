@@ -28,12 +28,29 @@
 #  features to be detected upon initial connection.
 #------------------------------------------------------------------------------
 
+import asyncio
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import math
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
 import socket
-import select
+import selectors
 import sys
 import re
+import tempfile
 import time
+import zlib
 
 #---[ Telnet Notes ]-----------------------------------------------------------
 # (See RFC 854 for more information)
@@ -77,9 +94,39 @@ import time
 UNKNOWN = -1
 ## Cap sockets to 512 on Windows because winsock can only process 512 at time
 ## Cap sockets to 1000 on Linux because you can only have 1024 file descriptors
+## These limits only apply to the 'select' backend, see make_selector().
 MAX_CONNECTIONS = 512 if sys.platform == 'win32' else 1000
 PARA_BREAK = re.compile(r"(\n\s*\n)", re.MULTILINE)
+NOT_NEWLINE = re.compile(r"[^\n]")
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
 AUTOSENSE_TIMEOUT = 15
+MAX_LINE_LENGTH = 4096  # Longer input lines are truncated
+MAX_COMMANDS = 1000     # Most lines of input queued per client
+MAX_OUTPUT_BYTES = 4194304      # Most bytes of output queued per client
+OUTPUT_HIGH_WATERMARK = 65536   # is_writable() turns False above this...
+OUTPUT_LOW_WATERMARK = 16384    # ...and True again, with on_drain, below this
+COLORIZE_CACHE_SIZE = 1024      # Rendered strings kept by colorize()
+COLORIZE_CACHE_MAX_LENGTH = 4096 # Longer strings are rendered, not cached
+SEND_SIZE = 65536       # Most bytes joined for a single socket send
+SEND_IOV_MAX = 1024     # Most chunks handed to a single sendmsg
+## Windows has no sendmsg(), fall back to joining chunks for send()
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+BUS_MAX_MESSAGE = 65536 # Largest message carried between worker processes
+TIMER_RESOLUTION = 0.05 # Seconds per tick of the timer wheel
+BACKLOG = 128           # Connections the kernel queues until we accept them
+MAX_ACCEPTS = 64        # Most connections accepted per poll
+RATE_LIMIT_PRUNE = 60   # Seconds between sweeps of the per address buckets
+FILE_ENCODING = 'utf-8' # Of the text files sent with send_file()
+## Where send_file() keeps files rendered ready to send, private to the
+## user since the renderings are mapped straight onto the wire
+FILE_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'miniboa-files-{}'.format(
+    os.getuid() if hasattr(os, 'getuid') else 'user'))
+FILE_CACHE_MAX_AGE = 86400  # Seconds before old renderings there are swept
+COMPRESS_LEVEL = 6      # zlib level of MCCP2 compressed output
+DEFAULT_ENCODING = 'cp1252' # Until the client agrees on a CHARSET
+## Character sets offered with CHARSET, in order of preference.  Only
+## stateless encodings: text is encoded a chunk at a time.
+CHARSETS = ('UTF-8', 'ISO-8859-1', 'WINDOWS-1252', 'US-ASCII')
 
 #--[ Telnet Commands ]---------------------------------------------------------
 
@@ -101,6 +148,9 @@ DONT    = chr(254)      # Don't = Demand or confirm option halt
 IAC     = chr(255)      # Interpret as Command
 SEND    = chr(  1)      # Sub-process negotiation SEND command
 IS      = chr(  0)      # Sub-process negotiation IS command
+REQUEST = chr(  1)      # CHARSET sub-negotiation commands, see RFC 2066
+ACCEPTED = chr( 2)
+REJECTED = chr( 3)
 
 #--[ Telnet Options ]----------------------------------------------------------
 
@@ -113,6 +163,8 @@ TTYPE   = chr( 24)      # Terminal Type
 NAWS    = chr( 31)      # Negotiate About Window Size
 TSPEED  = chr( 32)      # Terminal Speed
 LINEMO  = chr( 34)      # Line Mode
+CHARSET = chr( 42)      # Character Set
+MCCP2   = chr( 86)      # MUD Client Compression Protocol v2
 
 Telopts = {
     chr(0): "Binary representation",
@@ -122,9 +174,17 @@ Telopts = {
     chr(24): "Terminal Type",
     chr(31): "Negotiate About Window Size (NAWS)",
     chr(32): "Terminal Speed",
-    chr(34): "Line Mode"
+    chr(34): "Line Mode",
+    chr(42): "Character Set",
+    chr(86): "MUD Client Compression v2 (MCCP2)"
     }
 
+#--[ Overflow Policies ]-------------------------------------------------------
+
+DROP_NEWEST = 'drop newest'     # Discard what no longer fits
+DROP_OLDEST = 'drop oldest'     # Discard the oldest queued items to make room
+DISCONNECT  = 'disconnect'      # Deactivate the client
+
 #--[ Caret Code to ANSI TABLE ]------------------------------------------------
 
 ANSI_CODES = (
@@ -163,6 +223,10 @@ ANSI_CODES = (
     ( '^l', '\x1b[2K'),         # clear to end of line
     )
 
+## Lookup tables built from the above, keyed by the character after the caret
+CARET_TO_ANSI = dict((token[1], code) for token, code in ANSI_CODES)
+CARET_TO_PLAIN = dict((token[1], '') for token, code in ANSI_CODES)
+
 #--[ Connection Lost ]---------------------------------------------------------
 
 class ConnectionLost(Exception):
@@ -176,11 +240,7 @@ def strip_caret_codes(text):
     """
     Strip out any caret codes from a string.
     """
-    ## temporarily escape out ^^
-    text = text.replace('^^', '\x00')
-    for token, foo in ANSI_CODES:
-        text = text.replace(token, '')
-    return text.replace('\x00', '^')
+    return colorize(text, False)
 
 
 def colorize(text, ansi=True):
@@ -188,14 +248,62 @@ def colorize(text, ansi=True):
     If the client wants ansi, replace the tokens with ansi sequences --
     otherwise, simply strip them out.
     """
-    if ansi:
-        text = text.replace('^^', '\x00')
-        for token, code in ANSI_CODES:
-            text = text.replace(token, code)
-        text = text.replace('\x00', '^')
-    else:
-        text = strip_caret_codes(text)
-    return text
+    if '^' not in text:
+        return text
+    if len(text) > COLORIZE_CACHE_MAX_LENGTH:
+        return _render_caret_codes(text, ansi)
+    return _cached_render_caret_codes(text, ansi)
+
+
+def _render_caret_codes(text, ansi):
+    """
+    Translate all the caret codes in text in a single pass.
+    """
+    table = CARET_TO_ANSI if ansi else CARET_TO_PLAIN
+    parts = text.split('^')
+    out = [parts[0]]
+    append = out.append
+    count = len(parts)
+    index = 1
+    while index < count:
+        part = parts[index]
+        ## An empty part means '^^', an escaped caret
+        if not part and index + 1 < count:
+            append('^')
+            append(parts[index + 1])
+            index += 2
+            continue
+        code = table.get(part[:1])
+        if code is None:
+            append('^')
+            append(part)
+        else:
+            append(code)
+            append(part[1:])
+        index += 1
+    return ''.join(out)
+
+_cached_render_caret_codes = functools.lru_cache(COLORIZE_CACHE_SIZE)(
+    _render_caret_codes)
+
+
+def colorize_cache_info():
+    """
+    Return the hits, misses, maxsize and currsize of colorize()'s cache.
+    """
+    return _cached_render_caret_codes.cache_info()
+
+
+def visible_width(text):
+    """
+    Return how many columns text takes up on screen, not counting caret
+    codes and ANSI escape sequences.
+    """
+    if '^' in text:
+        text = _render_caret_codes(text, False)
+    if '\x1b' in text:
+        text = ANSI_ESCAPE.sub('', text)
+    return len(text)
 
 
 def word_wrap(text, columns=80, indent=4, padding=2):
@@ -203,23 +311,159 @@ def word_wrap(text, columns=80, indent=4, padding=2):
     Given a block of text, breaks into a list of lines wrapped to
     length.
     """
-    paragraphs = PARA_BREAK.split(text)
-    lines = []
+    return list(iter_wrap(text, columns, indent, padding))
+
+
+def iter_wrap(text, columns=80, indent=4, padding=2):
+    """
+    Generator version of word_wrap(), yielding the lines one at a time so
+    that very long texts can be streamed.  Caret codes and ANSI escapes do
+    not count towards the width of a line.
+    """
     columns -= padding
-    for para in paragraphs:
+    pos = 0
+    breaks = itertools.chain(PARA_BREAK.finditer(text), (None,))
+    for match in breaks:
+        if match is None:
+            para = text[pos:]
+        else:
+            para = text[pos:match.start()]
+            pos = match.end()
         if para.isspace():
             continue
-        line = ' ' * indent
+        ## Plain paragraphs can be measured with len()
+        measure = len
+        if '^' in para or '\x1b' in para:
+            measure = visible_width
+        parts = [' ' * indent]
+        length = indent
         for word in para.split():
-            if (len(line) + 1 + len(word)) > columns:
-                lines.append(line)
-                line = ' ' * padding
-                line += word
+            width = measure(word)
+            if length + 1 + width > columns:
+                yield ''.join(parts)
+                parts = [' ' * padding, word]
+                length = padding + width
             else:
-                line += ' ' + word
+                parts.append(' ')
+                parts.append(word)
+                length += 1 + width
+        line = ''.join(parts)
         if not line.isspace():
-            lines.append(line)
-    return lines
+            yield line
+
+#--[ Telnet Escaping ]---------------------------------------------------------
+
+def escape_iac(data):
+    """
+    Double every IAC (255) byte in data, so that the distant end reads it
+    as data rather than the start of a command.
+    """
+    if b'\xff' in data:
+        return data.replace(b'\xff', b'\xff\xff')
+    return data
+
+def _is_command(chunk):
+    """
+    True if a chunk of the send queue is a telnet command.  Text is queued
+    with IAC doubled, so only commands start with IAC and another byte.
+    """
+    return chunk[:1] == b'\xff' and chunk[1:2] != b'\xff'
+
+#--[ Static Files ]------------------------------------------------------------
+
+## (real path, ansi, encoding) -> (mtime, size, memoryview, rendered path)
+_rendered_files = {}
+## FILE_CACHE_DIR once checked, or a fresh directory if it was not safe
+_file_cache_dir = None
+
+def _cache_dir():
+    """
+    Return the directory for rendered files, creating FILE_CACHE_DIR with
+    mode 0700.  If it already exists but is not a directory owned by this
+    user that nobody else can write to, a new private one is made instead.
+    Renderings older than FILE_CACHE_MAX_AGE are swept the first time, so
+    those of files that changed or are no longer sent do not pile up.
+    """
+    global _file_cache_dir
+    if _file_cache_dir is not None:
+        return _file_cache_dir
+    try:
+        os.mkdir(FILE_CACHE_DIR, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(FILE_CACHE_DIR)
+    if (os.path.islink(FILE_CACHE_DIR) or not os.path.isdir(FILE_CACHE_DIR)
+            or (hasattr(os, 'getuid') and (info.st_uid != os.getuid()
+            or info.st_mode & 0o077))):
+        logging.warning("Not using '{}' for rendered files, it is not "
+            "private to this user".format(FILE_CACHE_DIR))
+        _file_cache_dir = tempfile.mkdtemp(prefix='miniboa-files-')
+    else:
+        _file_cache_dir = FILE_CACHE_DIR
+        _sweep_cache_dir(FILE_CACHE_DIR, time.time() - FILE_CACHE_MAX_AGE)
+    return _file_cache_dir
+
+def _sweep_cache_dir(path, before):
+    """
+    Remove the files in path last written before the given time.  Other
+    processes that still map one keep their mapping.
+    """
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_file(follow_symlinks=False) and entry.stat(
+                    follow_symlinks=False).st_mtime < before:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+def render_file(path, ansi=True, encoding=DEFAULT_ENCODING):
+    """
+    Return a text file with caret codes rendered ready for sending: codes
+    translated, LF converted into CR/LF, encoded and with IAC bytes
+    doubled.  Each variant is rendered once into FILE_CACHE_DIR and
+    memory mapped from there, until the file changes.
+    """
+    real_path = os.path.realpath(path)
+    stat = os.stat(real_path)
+    key = (real_path, ansi, encoding)
+    cached = _rendered_files.get(key)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    if cached is not None:
+        ## The file changed, its old rendering is of no more use.  Views
+        ## already queued for sending keep their mapping.
+        try:
+            os.remove(cached[3])
+        except OSError:
+            pass
+
+    cache_dir = _cache_dir()
+    name = hashlib.sha1(repr(key + (stat.st_mtime_ns, stat.st_size)).encode(
+        'utf-8')).hexdigest()
+    artifact = os.path.join(cache_dir, name)
+    if not os.path.exists(artifact):
+        with open(real_path, encoding=FILE_ENCODING, errors='replace') as source:
+            text = source.read()
+        data = escape_iac(_render_caret_codes(text, ansi).replace('\n',
+            '\r\n').encode(encoding, 'replace'))
+        ## Write it under a temporary name so other processes never map
+        ## half a file
+        with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as out:
+            out.write(data)
+        os.replace(out.name, artifact)
+
+    view = b''
+    with open(artifact, 'rb') as rendered:
+        if os.fstat(rendered.fileno()).st_size:
+            view = memoryview(mmap.mmap(rendered.fileno(), 0,
+                access=mmap.ACCESS_READ))
+    _rendered_files[key] = (stat.st_mtime_ns, stat.st_size, view, artifact)
+    return view
 
 #--[ Terminal Type enumerations - Mark Richardson Nov 2012]--------------------
 TERMINAL_TYPES = ['ANSI', 'XTERM', 'TINYFUGUE', 'zmud', 'VT100']
@@ -230,6 +474,8 @@ class TelnetOption(object):
     """
     Simple class used to track the status of an extended Telnet option.
     """
+    __slots__ = ('local_option', 'remote_option', 'reply_pending', 'option_text')
+
     def __init__(self):
         self.local_option = UNKNOWN     # Local state of an option
         self.remote_option = UNKNOWN    # Remote state of an option
@@ -237,6 +483,14 @@ class TelnetOption(object):
         self.option_text = "Unknown"    # Friendly text for debug or display
 
 
+## Clients keep the state of all 256 options packed one byte per option:
+## two bits each for the local and remote states and one for reply pending
+OPTION_LOCAL_SHIFT = 0
+OPTION_REMOTE_SHIFT = 2
+OPTION_STATE_MASK = 3
+OPTION_REPLY_PENDING = 16
+OPTION_STATES = (UNKNOWN, False, True)  # Indexed by the two state bits
+
 #--[ Telnet Client ]-----------------------------------------------------------
 AUTOSENSING   = 1
 GETUNAME      = 2
@@ -255,11 +509,30 @@ class TelnetClient(object):
 
     First argument is the socket discovered by the Telnet Server.
     Second argument is the tuple (ip address, port number).
+
+    Attributes are fixed by __slots__ to keep connections small; to add
+    your own, subclass without __slots__ and pass the subclass to the
+    server as client_class.
     """
+    __slots__ = ('protocol', 'server', '_active', 'sock', 'fileno', 'address',
+        'port', 'terminal_type', 'terminal_speed', 'use_ansi', 'columns',
+        'rows', '_send_pending', 'send_queue', 'send_queue_size',
+        'max_output_bytes', 'high_watermark', 'low_watermark',
+        'output_overflow', 'output_blocked', 'bytes_dropped', 'recv_buffer',
+        'bytes_sent', 'bytes_received', 'send_calls', 'recv_calls',
+        'cmd_ready', 'command_list', 'max_line_length', 'max_commands',
+        'input_overflow', 'commands_dropped', 'connect_time',
+        'last_input_time', 'autosensetimeout', 'client_state',
+        'telnet_got_iac', 'telnet_got_cmd', 'telnet_got_sb', 'telnet_options',
+        'telnet_echo', 'telnet_echo_password', 'telnet_sb_buffer',
+        'auto_sensing', 'auto_sensing_done', 'compressor', 'compress_level',
+        'zlib_pending', 'compress_in', 'compress_out', 'encoding', 'decoder',
+        'charsets', 'idle_timer', 'auto_sense_timer')
 
     def __init__(self, sock, addr_tup):
         self.protocol = 'telnet'
-        self.active = True          # Turns False when the connection is lost
+        self.server = None          # The TelnetServer we belong to, if any
+        self._active = True         # Turns False when the connection is lost
         self.sock = sock            # The connection's socket
         self.fileno = sock.fileno() # The socket's file descriptor
         self.address = addr_tup[0]  # The client's remote TCP/IP address
@@ -267,15 +540,39 @@ class TelnetClient(object):
         self.terminal_type = 'UNKNOWN' # set via request_terminal_type()
         self.terminal_speed = 'UNKNOWN' #set via request_terminal_speed()
         self.use_ansi = False       # Auto Sensing will turn this on if supported
+        self.encoding = None        # Codec name of the text we send and receive
+        self.decoder = None         # Incremental decoder for received text
+        self.charsets = None        # Offered with CHARSET, see request_charset()
+        self.idle_timer = None      # The server's timers for this client,
+        self.auto_sense_timer = None # cancelled when it disconnects
         self.columns = 80
         self.rows = 24
-        self.send_pending = False
-        self.send_buffer = ''
+        self._send_pending = False
+        self.send_queue = collections.deque() # Encoded chunks to send
+        self.send_queue_size = 0    # Bytes waiting in send_queue and zlib_pending
+        self.compressor = None      # zlib stream while MCCP2 is on
+        self.compress_level = None  # Offer MCCP2 at this level, see request_compression()
+        self.zlib_pending = b''     # Compressed bytes to send before the queue
+        self.compress_in = 0        # Bytes fed to the compressor
+        self.compress_out = 0       # Compressed bytes it produced
+        self.max_output_bytes = MAX_OUTPUT_BYTES
+        self.high_watermark = OUTPUT_HIGH_WATERMARK
+        self.low_watermark = OUTPUT_LOW_WATERMARK
+        self.output_overflow = DISCONNECT # What to do when output won't fit
+        self.output_blocked = False # Above the high watermark, not drained yet
+        self.bytes_dropped = 0
         self.recv_buffer = ''
         self.bytes_sent = 0
         self.bytes_received = 0
+        self.send_calls = 0         # Number of send syscalls made
+        self.recv_calls = 0         # Number of recv syscalls made
         self.cmd_ready = False
-        self.command_list = []
+        self.command_list = collections.deque()
+        self.max_line_length = MAX_LINE_LENGTH
+        self.max_commands = MAX_COMMANDS
+        self.input_overflow = DROP_NEWEST # What to do when the above are hit
+        self.commands_dropped = 0
+        self.set_encoding(DEFAULT_ENCODING)
         self.connect_time = time.time()
         self.last_input_time = time.time()
         self.autosensetimeout = time.time()
@@ -285,12 +582,40 @@ class TelnetClient(object):
         self.telnet_got_iac = False        # Are we inside an IAC sequence?
         self.telnet_got_cmd = None         # Did we get a telnet command?
         self.telnet_got_sb = False         # Are we inside a subnegotiation?
-        self.telnet_opt_dict = {}          # Mapping for up to 256 TelnetOptions
+        self.telnet_options = bytearray(256) # Packed state of every option
         self.telnet_echo = False           # Echo input back to the client?
         self.telnet_echo_password = False  # Echo back '*' for passwords?
         self.telnet_sb_buffer = ''         # Buffer for sub-negotiations
+        self.auto_sensing = False          #True while waiting for the negotiations
         self.auto_sensing_done = False     #True when all the negotiations are done
         
+    @property
+    def active(self):
+        """
+        False once the connection is lost or the client was deactivated.
+        """
+        return self._active
+
+    @active.setter
+    def active(self, state):
+        if self._active and not state and self.server is not None:
+            self.server._note_inactive(self)
+        self._active = state
+
+    @property
+    def send_pending(self):
+        """
+        True while there is data waiting to be sent to the client.
+        """
+        return self._send_pending
+
+    @send_pending.setter
+    def send_pending(self, state):
+        if state != self._send_pending:
+            self._send_pending = state
+            if self.server is not None:
+                self.server._note_send_pending(self)
+
     def detect_term_caps(self):
         """
         Send initial terminal negotiation options that we need and wait for the
@@ -302,7 +627,30 @@ class TelnetClient(object):
         self.request_terminal_speed()
         self.request_naws()
         self.autosensetimeout = time.time()
+        self.auto_sensing = True
+        if self.server is not None:
+            ## Make sure auto-sensing ends even if nobody polls for it
+            self.auto_sense_timer = self.server.call_later(
+                AUTOSENSE_TIMEOUT + TIMER_RESOLUTION, self._auto_sense_timeout)
+
+    def _auto_sense_timeout(self):
+        """
+        Timer callback ending auto-sensing if it is still going on.
+        """
+        if self.active and self.client_state == AUTOSENSING:
+            self.check_auto_sense()
         
+    def _cancel_timers(self):
+        """
+        Cancel the server timers that refer to us, so that a disconnected
+        client is not kept around until they fire.
+        """
+        for timer in (self.idle_timer, self.auto_sense_timer):
+            if timer is not None:
+                timer.cancel()
+        self.idle_timer = None
+        self.auto_sense_timer = None
+
     def check_auto_sense(self):
         """
         Checks the state of the telnet option negotiation started by detect_term_caps()
@@ -310,29 +658,53 @@ class TelnetClient(object):
         be changed to allow progress. If we dont get a reply to one of these
         a timer should allow client to proceed.
         """
-        if self._check_reply_pending(TTYPE) is False and \
-            self._check_reply_pending(TSPEED) is False and \
-            self._check_reply_pending(NAWS) is False:
-            
-            if(self.terminal_type in TERMINAL_TYPES):
-                self.use_ansi = True
-                self.send_cc("\n\r^YYour telnet client ^Gsupports^Y ANSI colors!^d\n\r")
-                
-            else:
-                self.send("\n\rYour client does not support ANSI colors, color turned off.\n\r")
-                
-            self.client_state = AUTHENTICATED
+        if self._auto_sense_replied():
+            self._auto_sense_complete()
             return
         
         else:
             if time.time() - self.autosensetimeout > AUTOSENSE_TIMEOUT:
                 self.use_ansi = False
                 self.send_cc("\n\rYour telnet client would not respond to our telnet negotiations.\n\r")                
-                self.client_state = AUTHENTICATED
+                self._auto_sense_complete()
             else:
                 self.send_cc('..')
                 
         return
+
+    def _auto_sense_replied(self):
+        """
+        True once the client answered all of detect_term_caps()'s requests.
+        """
+        return (self._check_reply_pending(TTYPE) is False and
+            self._check_reply_pending(TSPEED) is False and
+            self._check_reply_pending(NAWS) is False)
+
+    def _auto_sense_complete(self):
+        """
+        Leave the Auto-Sensing phase and tell the server about it.
+        """
+        if self._auto_sense_replied():
+            if(self.terminal_type in TERMINAL_TYPES):
+                self.use_ansi = True
+                self.send_cc("\n\r^YYour telnet client ^Gsupports^Y ANSI colors!^d\n\r")
+                
+            else:
+                self.send("\n\rYour client does not support ANSI colors, color turned off.\n\r")
+
+        self.client_state = AUTHENTICATED
+        self.auto_sensing = False
+        self.auto_sensing_done = True
+        self._fire('on_autosense_complete')
+
+    def _fire(self, name, *args):
+        """
+        Call the server's callback of the given name, if it has one, with
+        this client and args.
+        """
+        callback = getattr(self.server, name, None)
+        if callback is not None:
+            callback(self, *args)
         
     def get_command(self):
         """
@@ -340,22 +712,172 @@ class TelnetClient(object):
         cmd_ready attribute will be true if lines are available.
         """
         cmd = None
-        count = len(self.command_list)
-        if count > 0:
-            cmd = self.command_list.pop(0)
+        if self.command_list:
+            cmd = self.command_list.popleft()
 
         ## If that was the last line, turn off lines_pending
-        if count == 1:
-            self.cmd_ready = False
+        self.cmd_ready = bool(self.command_list)
         return cmd
 
+    def get_commands(self, max_n=None):
+        """
+        Get a list of up to max_n lines of text received from the client, or
+        all of them if max_n is None.
+        """
+        queue = self.command_list
+        if max_n is None or max_n >= len(queue):
+            cmds = list(queue)
+            queue.clear()
+        else:
+            cmds = [queue.popleft() for i in range(max_n)]
+        self.cmd_ready = bool(queue)
+        return cmds
+
     def send(self, text):
         """
         Send raw text to the distant end.
         """
         if text:
-            self.send_buffer += text.replace('\n', '\r\n')
-            self.send_pending = True
+            self._send_bytes(escape_iac(text.replace('\n', '\r\n').encode(
+                self.encoding, 'replace')))
+
+    def send_binary(self, data):
+        """
+        Send bytes as they are, apart from IAC bytes which are doubled.
+        Unless the client agreed to BINARY, see request_binary(), LF is
+        sent as CR/LF like the rest of our output.
+        """
+        if not data:
+            return
+        if not self.is_binary():
+            data = data.replace(b'\n', b'\r\n')
+        self._send_bytes(escape_iac(data))
+
+    def is_binary(self):
+        """
+        True if the client agreed to us transmitting in BINARY mode.
+        """
+        return self._check_local_option(BINARY) is True
+
+    def _send_bytes(self, data):
+        """
+        Queue already encoded bytes for sending, within the output budgets.
+        """
+        if not self._active:
+            return
+        size = len(data)
+        if not self._output_fits(size) and not self._output_overflow(size):
+            return
+        self._queue_bytes(data)
+
+    def _queue_bytes(self, data):
+        """
+        Queue bytes for sending whatever the output budgets say.
+        """
+        size = len(data)
+        server = self.server
+        self.send_queue.append(data)
+        self.send_queue_size += size
+        if server is not None:
+            server.output_bytes += size
+        if self.send_queue_size > self.high_watermark:
+            self.output_blocked = True
+        self.send_pending = True
+
+    def _output_fits(self, size):
+        """
+        Check size more bytes of output against our budget and, if we are
+        above the low watermark, the server-wide one.
+        """
+        if self.send_queue_size + size > self.max_output_bytes:
+            return False
+        server = self.server
+        return (server is None or server.max_output_bytes is None or
+            server.output_bytes + size <= server.max_output_bytes or
+            self.send_queue_size <= self.low_watermark)
+
+    def _output_overflow(self, size):
+        """
+        Apply the output overflow policy when size more bytes do not fit in
+        the budgets.  Returns True if they may be queued after all.
+        """
+        if self.output_overflow == DROP_OLDEST:
+            ## Make room by dropping whole chunks, but never the first one
+            ## as it may have been partly sent already, nor telnet commands
+            queue = self.send_queue
+            if queue:
+                ## Pop from the front and put the survivors back after, as
+                ## deleting from the middle of a deque is linear each time
+                kept = [queue.popleft()]
+                while queue and not self._output_fits(size):
+                    chunk = queue.popleft()
+                    if _is_command(chunk):
+                        kept.append(chunk)
+                        continue
+                    self._output_dropped(len(chunk))
+                    self._output_dequeued(len(chunk))
+                queue.extendleft(reversed(kept))
+            if self._output_fits(size):
+                return True
+        elif self.output_overflow == DISCONNECT:
+            logging.warning("Output budget exceeded for {}, disconnecting".format(self.addrport()))
+            self._output_dropped(size)
+            self.discard_output()
+            self.deactivate()
+            return False
+        self._output_dropped(size)
+        return False
+
+    def _output_dropped(self, size):
+        """
+        Account for size bytes of output that will never be sent.
+        """
+        self.bytes_dropped += size
+        if self.server is not None:
+            self.server.bytes_dropped += size
+
+    def _output_dequeued(self, size):
+        """
+        Account for size bytes leaving the send queue, firing on_drain once
+        it falls to the low watermark.
+        """
+        self.send_queue_size -= size
+        if self.server is not None:
+            self.server.output_bytes -= size
+        if self.output_blocked and self.send_queue_size <= self.low_watermark:
+            self.output_blocked = False
+            self._fire('on_drain')
+
+    def discard_output(self):
+        """
+        Throw away everything waiting to be sent.  While the client is
+        connected, compressed output already in zlib_pending is kept: the
+        client has inflated the stream up to it and could not make sense
+        of anything after a gap.
+        """
+        if not self._active:
+            self.zlib_pending = b''
+        size = self.send_queue_size - len(self.zlib_pending)
+        self.output_blocked = False
+        self._output_dropped(size)
+        self._output_dequeued(size)
+        self.send_queue.clear()
+        self.send_pending = bool(self.zlib_pending)
+
+    def is_writable(self):
+        """
+        False while the output queue is above the high watermark and has not
+        drained to the low watermark yet; on_drain is fired when it has.
+        """
+        return not self.output_blocked
+
+    def _send_command(self, command):
+        """
+        Queue a telnet command, bypassing text encoding.  Commands are never
+        dropped for the output budgets, the session depends on them.
+        """
+        if self._active:
+            self._queue_bytes(bytes(command, "latin-1"))
 
     def send_cc(self, text):
         """
@@ -363,13 +885,65 @@ class TelnetClient(object):
         """
         self.send(colorize(text, self.use_ansi))
 
+    def render(self, text):
+        """
+        Return text with caret codes converted, encoded ready for sending.
+        """
+        return escape_iac(colorize(text, self.use_ansi).replace('\n',
+            '\r\n').encode(self.encoding, 'replace'))
+
+    def render_key(self):
+        """
+        Return a key shared by all clients that render() text identically.
+        """
+        return (self.use_ansi, self.encoding)
+
+    def set_encoding(self, name):
+        """
+        Send and receive text in the named encoding from now on.  Raises
+        LookupError if Python has no codec for it.
+        """
+        self.encoding = codecs.lookup(name).name
+        self.decoder = codecs.getincrementaldecoder(self.encoding)('replace')
+
+    def _decode(self, data):
+        """
+        Decode received bytes, keeping any incomplete character at the end
+        for next time.  ASCII is decoded without going through the codec
+        when it has nothing left over.  It still becomes a str here rather
+        than staying bytes until line framing: lines, echo and on_command
+        all work on text, so every byte would have to be decoded anyway.
+        """
+        if data.isascii() and not self.decoder.getstate()[0]:
+            return str(data, 'ascii')
+        return self.decoder.decode(data)
+
     def send_wrapped(self, text):
         """
         Send text padded and wrapped to the user's screen width.
         """
-        lines = word_wrap(text, self.columns)
-        for line in lines:
-            self.send_cc(line + '\n')
+        wrapped = ''.join(line + '\n' for line in iter_wrap(text, self.columns))
+        if wrapped:
+            self._send_bytes(self.render(wrapped))
+
+    def send_file(self, path, ansi=None):
+        """
+        Send a text file with caret codes, such as a help page or a map.
+        It is rendered once for each variant and then queued straight from
+        a memory mapped copy, see render_file().  ansi defaults to the
+        client's use_ansi.
+        """
+        if ansi is None:
+            ansi = self.use_ansi
+        data = render_file(path, ansi, self.encoding)
+        if data:
+            self._send_bytes(data)
+
+    def send_message(self, message):
+        """
+        Send a Message, rendered for this client's terminal.
+        """
+        self._send_bytes(message.render(self))
 
     def deactivate(self):
         """
@@ -434,6 +1008,14 @@ class TelnetClient(object):
         self._iac_wont(ECHO)
         self._note_reply_pending(ECHO, True)
 
+    def request_binary(self):
+        """
+        Ask to transmit in BINARY mode, letting send_binary() skip the
+        CR/LF translation.  See RFC 856.
+        """
+        self._iac_will(BINARY)
+        self._note_reply_pending(BINARY, True)
+
     def request_naws(self):
         """
         Request to Negotiate About Window Size.  See RFC 1073.
@@ -457,21 +1039,200 @@ class TelnetClient(object):
         self._iac_do(TSPEED)
         self._note_reply_pending(TSPEED, True)    
 
+    def request_compression(self, level=COMPRESS_LEVEL):
+        """
+        Offer to compress our output with MCCP2, the MUD Client Compression
+        Protocol.  Compression starts when the client agrees.
+        """
+        self.compress_level = level
+        self._iac_will(MCCP2)
+        self._note_reply_pending(MCCP2, True)
+
+    def request_charset(self, charsets=CHARSETS):
+        """
+        Offer to agree on a character set other than the default with the
+        client.  See RFC 2066.
+        """
+        self.charsets = charsets
+        self._iac_will(CHARSET)
+        self._note_reply_pending(CHARSET, True)
+
+    def _charset_request(self):
+        """
+        Send the character sets we offer, the client picks one.
+        """
+        self._send_command(IAC + SB + CHARSET + REQUEST + ';' +
+            ';'.join(self.charsets) + IAC + SE)
+
+    def _offered_charset(self, name):
+        """
+        Return True if name is one of the character sets we offered.  Only
+        those are ever switched to, whatever else Python has a codec for.
+        """
+        try:
+            wanted = codecs.lookup(name).name
+        except LookupError:
+            return False
+        for offered in self.charsets or ():
+            try:
+                if codecs.lookup(offered).name == wanted:
+                    return True
+            except LookupError:
+                continue
+        return False
+
+    def _charset_reply(self, names):
+        """
+        Answer the client's own CHARSET REQUEST with the first of its
+        character sets that we offer too.
+        """
+        for name in names:
+            if self._offered_charset(name):
+                self._send_command(IAC + SB + CHARSET + ACCEPTED + name +
+                    IAC + SE)
+                self.set_encoding(name)
+                return
+        self._send_command(IAC + SB + CHARSET + REJECTED + IAC + SE)
+
+    def compression_ratio(self):
+        """
+        Return the size of our compressed output relative to the original,
+        or None if nothing has been compressed.
+        """
+        if not self.compress_in:
+            return None
+        return self.compress_out / self.compress_in
+
+    def _start_compression(self):
+        """
+        Tell the client that what follows is compressed and start doing so.
+        """
+        self._send_command(IAC + SB + MCCP2 + IAC + SE)
+        ## Everything queued up to here goes out as it is
+        queue = self.send_queue
+        self.zlib_pending = bytes(self.zlib_pending) + b''.join(queue)
+        queue.clear()
+        self.compressor = zlib.compressobj(self.compress_level)
+
+    def _end_compression(self):
+        """
+        Finish the compressed stream, output after it is sent as it is.
+        """
+        self._compress_queue(zlib.Z_FINISH)
+        self.compressor = None
+
+    def _compress_queue(self, mode):
+        """
+        Compress everything queued onto zlib_pending and flush the stream.
+        """
+        queue = self.send_queue
+        raw = b''.join(queue)
+        queue.clear()
+        data = self.compressor.compress(raw) + self.compressor.flush(mode)
+        self.compress_in += len(raw)
+        self.compress_out += len(data)
+        self.zlib_pending = bytes(self.zlib_pending) + data
+        ## The queue shrinks from the raw size to the compressed size
+        self._output_dequeued(len(raw) - len(data))
+
+    def _send_zlib_pending(self):
+        """
+        Send what we can of zlib_pending.  Returns True once it is empty.
+        """
+        data = self.zlib_pending
+        try:
+            sent = self.sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except socket.error as err:
+            logging.error("SEND error '{}' from {}".format(err, self.addrport()))
+            self.active = False
+            return False
+        self.send_calls += 1
+        self.bytes_sent += sent
+        self._output_dequeued(sent)
+        if sent < len(data):
+            self.zlib_pending = memoryview(data)[sent:]
+            return False
+        self.zlib_pending = b''
+        return True
+
+    def _take_send_data(self):
+        """
+        Remove and return everything waiting to be sent as bytes.  Used by
+        transports that do their own buffering, see TelnetProtocol.
+        """
+        if self.compressor is not None and self.send_queue:
+            self._compress_queue(zlib.Z_SYNC_FLUSH)
+        data = bytes(self.zlib_pending) + b''.join(self.send_queue)
+        self.zlib_pending = b''
+        self.send_queue.clear()
+        self.bytes_sent += len(data)
+        self._output_dequeued(len(data))
+        self.send_pending = False
+        return data
+
+    def _join_send_queue(self):
+        """
+        Coalesce small chunks at the head of the queue into one of up to
+        SEND_SIZE bytes and return it.
+        """
+        queue = self.send_queue
+        data = queue[0]
+        if len(queue) > 1 and len(data) < SEND_SIZE:
+            size = 0
+            chunks = []
+            while queue and size < SEND_SIZE:
+                chunk = queue.popleft()
+                chunks.append(chunk)
+                size += len(chunk)
+            data = b''.join(chunks)
+            queue.appendleft(data)
+        return data
+
     def socket_send(self):
         """
         Called by TelnetServer when send data is ready.
         """
-        if len(self.send_buffer):
+        if self.zlib_pending and not self._send_zlib_pending():
+            return
+        if self.compressor is not None:
+            if self.send_queue:
+                ## Once per poll, compress what was queued since the last
+                ## one and sync flush so the client can show it all
+                self._compress_queue(zlib.Z_SYNC_FLUSH)
+                if not self._send_zlib_pending():
+                    return
+            self.send_pending = False
+            return
+
+        queue = self.send_queue
+        if queue:
             try:
-                #convert to ansi before sending
-                sent = self.sock.send(bytes(self.send_buffer, "cp1252"))
+                if HAVE_SENDMSG:
+                    ## Hand the kernel the whole queue in one writev
+                    sent = self.sock.sendmsg(itertools.islice(queue, SEND_IOV_MAX))
+                else:
+                    sent = self.sock.send(self._join_send_queue())
+            except (BlockingIOError, InterruptedError):
+                return
             except socket.error as err:
-                logging.error("SEND error '{}:{}' from {}".format(err[0], err[1], self.addrport()))
+                logging.error("SEND error '{}' from {}".format(err, self.addrport()))
                 self.active = False
                 return
+            self.send_calls += 1
             self.bytes_sent += sent
-            self.send_buffer = self.send_buffer[sent:]
-        else:
+            self._output_dequeued(sent)
+
+            ## Drop what went out, a partial chunk is advanced without copying
+            while sent:
+                chunk = queue[0]
+                if sent < len(chunk):
+                    queue[0] = memoryview(chunk)[sent:]
+                    break
+                queue.popleft()
+                sent -= len(chunk)
+        if not queue:
             self.send_pending = False
 
     def socket_recv(self):
@@ -479,57 +1240,146 @@ class TelnetClient(object):
         Called by TelnetServer when recv data is ready.
         """
         try:
-            #Encode recieved bytes in ansi
-            data = str(self.sock.recv(2048), "cp1252")
+            data = self.sock.recv(2048)
+        except (BlockingIOError, InterruptedError):
+            return
         except socket.error as err:
-            logging.error("RECIEVE socket error '{}:{}' from {}".format(err[0], err[1], self.addrport()))
+            logging.error("RECIEVE socket error '{}' from {}".format(err, self.addrport()))
             raise ConnectionLost()
+        self.recv_calls += 1
 
         ## Did they close the connection?
-        size = len(data)
-        if size == 0:
+        if not data:
             logging.debug ("No data recieved, client closed connection")
             raise ConnectionLost()
 
+        self.feed(data)
+
+    def feed(self, data):
+        """
+        Process bytes received from the distant end: strip and act on telnet
+        commands and split the rest into lines for get_command().
+        """
         ## Update some trackers
         self.last_input_time = time.time()
-        self.bytes_received += size
+        self.bytes_received += len(data)
 
-        ## Test for telnet commands
-        for byte in data:
-            self._iac_sniffer(byte)
+        ## Test for telnet commands, the rest is split into lines
+        self._iac_parse(data)
 
-        ## Look for newline characters to get whole lines from the buffer
-        while True:
-            mark = self.recv_buffer.find('\n')
+    def _iac_parse(self, data):
+        """
+        Bulk version of _iac_sniffer() working on bytes.  Runs of plain data
+        between IAC bytes are passed on a slice at a time, only the IAC
+        sequences themselves go through the per-byte state machine.
+        """
+        pos = 0
+        end = len(data)
+        while pos < end:
+
+            ## Inside an IAC sequence, feed it one byte at a time
+            if self.telnet_got_iac:
+                self._iac_sniffer(chr(data[pos]))
+                pos += 1
+                continue
+
+            ## Find the next IAC (255)
+            mark = data.find(b'\xff', pos)
             if mark == -1:
-                break
-            cmd = self.recv_buffer[:mark].strip()
-            self.command_list.append(cmd)
-            self.cmd_ready = True
-            self.recv_buffer = self.recv_buffer[mark+1:]
+                mark = end
 
-    def _recv_byte(self, byte):
+            if self.telnet_got_sb:
+                ## Sanity check on length, the byte that overflows the
+                ## buffer aborts the sub-negotiation and is dropped
+                room = max(0, 64 - len(self.telnet_sb_buffer))
+                if mark - pos > room:
+                    self.telnet_got_sb = False
+                    self.telnet_sb_buffer = ''
+                    pos += room + 1
+                    continue
+                ## Sub-negotiation values are binary, keep them byte for char
+                self.telnet_sb_buffer += str(data[pos:mark], "latin-1")
+
+            elif mark > pos:
+                self._recv_text(self._decode(data[pos:mark]))
+
+            if mark < end:
+                self.telnet_got_iac = True
+            pos = mark + 1
+
+    def _recv_text(self, text):
         """
-        Non-printable filtering currently disabled because it did not play
-        well with extended character sets.
+        Add received text to the line buffer, queueing each completed line.
+        Only the new text is scanned for newlines.
         """
-        ## Filter out non-printing characters
-        #if (byte >= ' ' and byte <= '~') or byte == '\n':
         if self.telnet_echo:
-            self._echo_byte(byte)
-        self.recv_buffer += byte
+            self._echo_text(text)
+
+        max_length = self.max_line_length
+        lines = text.split('\n')
+        if len(lines) > 1:
+            lines[0] = self.recv_buffer + lines[0]
+            for line in itertools.islice(lines, len(lines) - 1):
+                if len(line) > max_length:
+                    line = self._line_overflow(line)
+                self._queue_command(line.strip())
+            self.recv_buffer = lines[-1]
+        else:
+            self.recv_buffer += text
+
+        ## Sanity check on length
+        if len(self.recv_buffer) > max_length:
+            self.recv_buffer = self._line_overflow(self.recv_buffer)
+
+    def _line_overflow(self, line):
+        """
+        Apply the input overflow policy to a line that is too long.
+        """
+        if self.input_overflow == DISCONNECT:
+            logging.warning("Line too long from {}, disconnecting".format(self.addrport()))
+            self.deactivate()
+        return line[:self.max_line_length]
+
+    def _queue_command(self, cmd):
+        """
+        Queue a line of input for get_command(), applying the input overflow
+        policy when the queue is full.
+        """
+        if getattr(self.server, 'on_command', None) is not None:
+            self.server.on_command(self, cmd)
+            return
+        queue = self.command_list
+        if len(queue) >= self.max_commands:
+            self.commands_dropped += 1
+            if self.input_overflow == DROP_OLDEST:
+                queue.popleft()
+            elif self.input_overflow == DISCONNECT:
+                logging.warning("Too many commands from {}, disconnecting".format(self.addrport()))
+                self.deactivate()
+                return
+            else:
+                return
+        queue.append(cmd)
+        self.cmd_ready = True
 
-    def _echo_byte(self, byte):
+    def _echo_text(self, text):
         """
-        Echo a character back to the client and convert LF into CR\LF.
+        Echo text back to the client and convert LF into CR\LF.
         """
-        if byte == '\n':
-            self.send_buffer += '\r'
         if self.telnet_echo_password:
-            self.send_buffer += '*'
+            text = NOT_NEWLINE.sub('*', text).replace('\n', '\r*')
         else:
-            self.send_buffer += byte
+            text = text.replace('\n', '\r\n')
+        self._send_bytes(escape_iac(text.encode(self.encoding, 'replace')))
+
+    def _recv_byte(self, byte):
+        """
+        Non-printable filtering currently disabled because it did not play
+        well with extended character sets.
+        """
+        ## Filter out non-printing characters
+        #if (byte >= ' ' and byte <= '~') or byte == '\n':
+        self._recv_text(byte)
 
     def _iac_sniffer(self, byte):
         """
@@ -617,6 +1467,10 @@ class TelnetClient(object):
             self.telnet_got_sb = False
             self._sb_decoder()
 
+        elif cmd == IAC:
+            ## An escaped 255 in the data
+            self._recv_text(self._decode(b'\xff'))
+
         elif cmd == NOP:
             pass
 
@@ -670,6 +1524,30 @@ class TelnetClient(object):
                     if option == ECHO:
                         self.telnet_echo = True
 
+            elif option == CHARSET and self.charsets is not None:
+
+                if self._check_reply_pending(option):
+                    self._note_reply_pending(option, False)
+                    self._note_local_option(option, True)
+                    self._charset_request()
+
+                elif self._check_local_option(option) is not True:
+                    self._note_local_option(option, True)
+                    self._iac_will(option)
+                    self._charset_request()
+
+            elif option == MCCP2 and self.compress_level is not None:
+
+                if self._check_reply_pending(option):
+                    self._note_reply_pending(option, False)
+                    self._note_local_option(option, True)
+                    self._start_compression()
+
+                elif self._check_local_option(option) is not True:
+                    self._note_local_option(option, True)
+                    self._iac_will(option)
+                    self._start_compression()
+
             else:
                 ## All other options = Default to refusing once
                 if self._check_local_option(option) is UNKNOWN:
@@ -690,8 +1568,30 @@ class TelnetClient(object):
                     ## Just nod unless setting echo
                     if option == ECHO:
                         self.telnet_echo = False
-            else:
-                ## All other options = Default to ignoring
+
+            elif option == CHARSET:
+
+                if self._check_reply_pending(option):
+                    self._note_reply_pending(option, False)
+                    self._note_local_option(option, False)
+
+                elif self._check_local_option(option) is True:
+                    self._note_local_option(option, False)
+                    self._iac_wont(option)
+
+            elif option == MCCP2:
+
+                if self._check_reply_pending(option):
+                    self._note_reply_pending(option, False)
+                    self._note_local_option(option, False)
+
+                elif self._check_local_option(option) is True:
+                    self._note_local_option(option, False)
+                    self._iac_wont(option)
+                    if self.compressor is not None:
+                        self._end_compression()
+            else:
+                ## All other options = Default to ignoring
                 pass
 
 
@@ -721,7 +1621,7 @@ class TelnetClient(object):
                     #self._note_reply_pending(TTYPE, False)
                     self._note_remote_option(TTYPE, True)
                     ## Tell them to send their terminal type
-                    self.send("{}{}{}{}{}{}".format(IAC, SB, TTYPE, SEND, IAC, SE))
+                    self._send_command(IAC + SB + TTYPE + SEND + IAC + SE)
 
                 elif (self._check_remote_option(TTYPE) is False or
                         self._check_remote_option(TTYPE) is UNKNOWN):
@@ -733,7 +1633,7 @@ class TelnetClient(object):
                     self._note_reply_pending(TSPEED, False)
                     self._note_remote_option(TSPEED, True)
                     ## Tell them to send their terminal speed
-                    self.send("{}{}{}{}{}{}".format(IAC, SB, TSPEED, SEND, IAC, SE))
+                    self._send_command(IAC + SB + TSPEED + SEND + IAC + SE)
                     
                 elif (self._check_remote_option(TSPEED) is False or
                       self._check_remote_option(TSPEED) is UNKNOWN):
@@ -779,6 +1679,7 @@ class TelnetClient(object):
 
         self.telnet_got_iac = False
         self.telnet_got_cmd = None
+        self._check_auto_sensed()
 
     def _sb_decoder(self):
         """
@@ -800,12 +1701,36 @@ class TelnetClient(object):
                 if len(bloc) != 5:
                     logging.warning("Bad length on NAWS SB: " + str(len(bloc)))
                 else:
+                    size = (self.columns, self.rows)
                     self.columns = (256 * ord(bloc[1])) + ord(bloc[2])
                     self.rows = (256 * ord(bloc[3])) + ord(bloc[4])
+                    if (self.columns, self.rows) != size:
+                        self._fire('on_resize')
 
                 #logging.info("Screen is {} x {}".format(self.columns, self.rows))
 
+            if bloc[0] == CHARSET and self.charsets is not None:
+                if bloc[1] == ACCEPTED:
+                    if self._offered_charset(bloc[2:]):
+                        self.set_encoding(bloc[2:])
+                    else:
+                        logging.warning("Client accepted charset '{}' that was not offered".format(bloc[2:]))
+                elif bloc[1] == REQUEST:
+                    ## The first byte after REQUEST separates the names
+                    self._charset_reply(bloc[3:].split(bloc[2]))
+
+        elif bloc[:2] == CHARSET + REJECTED:
+            logging.debug("Client rejected our character sets")
+
         self.telnet_sb_buffer = ''
+        self._check_auto_sensed()
+
+    def _check_auto_sensed(self):
+        """
+        Complete auto-sensing as soon as the last reply comes in.
+        """
+        if self.auto_sensing and self._auto_sense_replied():
+            self._auto_sense_complete()
 
 
     #---[ State Juggling for Telnet Options ]----------------------------------
@@ -813,72 +1738,522 @@ class TelnetClient(object):
     ## Sometimes verbiage is tricky.  I use 'note' rather than 'set' here
     ## because (to me) set infers something happened.
 
+    @property
+    def telnet_opt_dict(self):
+        """
+        Mapping of option to TelnetOption for every option negotiated so
+        far.  Built on demand from the packed option table, so read it once
+        rather than on every lookup, or use get_option().
+        """
+        opt_dict = {}
+        for index, packed in enumerate(self.telnet_options):
+            if packed:
+                option = chr(index)
+                opt_dict[option] = self.get_option(option)
+        return opt_dict
+
+    def get_option(self, option):
+        """
+        Return the TelnetOption for one option, or None if it has not been
+        negotiated.
+        """
+        packed = self.telnet_options[ord(option)]
+        if not packed:
+            return None
+        opt = TelnetOption()
+        opt.local_option = OPTION_STATES[packed & OPTION_STATE_MASK]
+        opt.remote_option = OPTION_STATES[(packed >> OPTION_REMOTE_SHIFT) & OPTION_STATE_MASK]
+        opt.reply_pending = bool(packed & OPTION_REPLY_PENDING)
+        opt.option_text = Telopts.get(option, "Unknown")
+        return opt
+
+    def _note_option_state(self, option, shift, state):
+        index = ord(option)
+        self.telnet_options[index] = ((self.telnet_options[index] &
+            ~(OPTION_STATE_MASK << shift)) | ((2 if state else 1) << shift))
+
     def _check_local_option(self, option):
         """Test the status of local negotiated Telnet options."""
-        if option not in self.telnet_opt_dict:
-        #if not self.telnet_opt_dict.has_key(option):
-            self.telnet_opt_dict[option] = TelnetOption()
-        return self.telnet_opt_dict[option].local_option
+        return OPTION_STATES[self.telnet_options[ord(option)] & OPTION_STATE_MASK]
 
     def _note_local_option(self, option, state):
         """Record the status of local negotiated Telnet options."""
-        if option not in self.telnet_opt_dict:
-        #if not self.telnet_opt_dict.has_key(option):
-            self.telnet_opt_dict[option] = TelnetOption()
-        self.telnet_opt_dict[option].local_option = state
-        self.telnet_opt_dict[option].option_text = Telopts[option]
+        self._note_option_state(option, OPTION_LOCAL_SHIFT, state)
 
     def _check_remote_option(self, option):
         """Test the status of remote negotiated Telnet options."""
-        if option not in self.telnet_opt_dict:
-        #if not self.telnet_opt_dict.has_key(option):
-            self.telnet_opt_dict[option] = TelnetOption()
-        return self.telnet_opt_dict[option].remote_option
+        return OPTION_STATES[(self.telnet_options[ord(option)] >>
+            OPTION_REMOTE_SHIFT) & OPTION_STATE_MASK]
 
     def _note_remote_option(self, option, state):
         """Record the status of local negotiated Telnet options."""
-        if option not in self.telnet_opt_dict:
-        #if not self.telnet_opt_dict.has_key(option):
-            self.telnet_opt_dict[option] = TelnetOption()
-        self.telnet_opt_dict[option].remote_option = state
-        self.telnet_opt_dict[option].option_text = Telopts[option]
+        self._note_option_state(option, OPTION_REMOTE_SHIFT, state)
 
     def _check_reply_pending(self, option):
         """Test the status of requested Telnet options."""
-        if option not in self.telnet_opt_dict:
-        #if not self.telnet_opt_dict.has_key(option):
-            self.telnet_opt_dict[option] = TelnetOption()
-        return self.telnet_opt_dict[option].reply_pending
+        return bool(self.telnet_options[ord(option)] & OPTION_REPLY_PENDING)
 
     def _note_reply_pending(self, option, state):
         """Record the status of requested Telnet options."""
-        if option not in self.telnet_opt_dict:
-        #if not self.telnet_opt_dict.has_key(option):
-            self.telnet_opt_dict[option] = TelnetOption()
-        self.telnet_opt_dict[option].reply_pending = state
+        if state:
+            self.telnet_options[ord(option)] |= OPTION_REPLY_PENDING
+        else:
+            self.telnet_options[ord(option)] &= ~OPTION_REPLY_PENDING & 0xff
 
 
     #---[ Telnet Command Shortcuts ]-------------------------------------------
 
     def _iac_do(self, option):
         """Send a Telnet IAC "DO" sequence."""
-        self.send("{}{}{}".format(IAC, DO, option))
+        self._send_command(IAC + DO + option)
 
     def _iac_dont(self, option):
         """Send a Telnet IAC "DONT" sequence."""
-        self.send("{}{}{}".format(IAC, DONT, option))
+        self._send_command(IAC + DONT + option)
 
     def _iac_will(self, option):
         """Send a Telnet IAC "WILL" sequence."""
-        self.send("{}{}{}".format(IAC, WILL, option))
+        self._send_command(IAC + WILL + option)
 
     def _iac_wont(self, option):
         """Send a Telnet IAC "WONT" sequence."""
-        self.send("{}{}{}".format(IAC, WONT, option))
+        self._send_command(IAC + WONT + option)
+
+
+#--[ Timer Wheel ]-------------------------------------------------------------
+
+class Timer(object):
+    """
+    A callback scheduled on a TimerWheel.
+    """
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Stop the callback from being called.
+        """
+        self.cancelled = True
+        ## Let go of what the callback refers to until the slot comes round
+        self.callback = None
+        self.args = ()
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timer wheel.  Scheduling and cancelling cost O(1) and
+    advancing costs O(timers expiring) plus one step per elapsed tick;
+    timers far in the future sit in coarser levels and cascade down as
+    their time approaches.
+    """
+    SLOT_BITS = 6
+    SLOTS = 1 << SLOT_BITS
+    LEVELS = 4
+
+    def __init__(self, resolution=TIMER_RESOLUTION, now=None):
+        self.resolution = resolution
+        self.current = self._tick(time.time() if now is None else now)
+        self.wheels = [[[] for slot in range(self.SLOTS)]
+            for level in range(self.LEVELS)]
+        self.count = 0
+
+    def _tick(self, when):
+        return int(when / self.resolution)
+
+    def schedule(self, when, callback, *args):
+        """
+        Call callback(*args) once time.time() reaches when.  Returns a Timer
+        that can be cancelled.
+        """
+        timer = Timer(when, callback, args)
+        self._insert(timer)
+        self.count += 1
+        return timer
+
+    def _insert(self, timer):
+        ## Round up so that timers never fire early
+        ticks = max(int(math.ceil(timer.when / self.resolution)), self.current)
+        delta = ticks - self.current
+        for level in range(self.LEVELS):
+            if delta < 1 << (self.SLOT_BITS * (level + 1)):
+                break
+        else:
+            ## Beyond the wheel's range, park it at the far end of the top
+            ## level; it is reinserted when it cascades down
+            ticks = self.current + (1 << (self.SLOT_BITS * self.LEVELS)) - 1
+        slot = (ticks >> (self.SLOT_BITS * level)) & (self.SLOTS - 1)
+        self.wheels[level][slot].append(timer)
+
+    def _cascade(self, level):
+        """
+        Move the timers of the current slot of a level down the wheel.
+        """
+        slot = (self.current >> (self.SLOT_BITS * level)) & (self.SLOTS - 1)
+        timers = self.wheels[level][slot]
+        self.wheels[level][slot] = []
+        for timer in timers:
+            self._insert(timer)
+        return slot
+
+    def advance(self, now=None):
+        """
+        Call every timer that is due.
+        """
+        target = self._tick(time.time() if now is None else now)
+        mask = self.SLOTS - 1
+        while self.current <= target:
+            ## Skip straight to the next tick with something to do
+            ticks = self._next_tick()
+            if ticks is None or ticks > target:
+                self.current = target + 1
+                break
+            self.current = ticks
+            slot = ticks & mask
+            ## Cascade higher levels as each lower level wraps around
+            if slot == 0:
+                level = 1
+                while level < self.LEVELS and self._cascade(level) == 0:
+                    level += 1
+            timers = self.wheels[0][slot]
+            self.wheels[0][slot] = []
+            ## Move on first, so timers scheduled by the callbacks land in
+            ## a slot that is still ahead of us
+            self.current += 1
+            for timer in timers:
+                self.count -= 1
+                if not timer.cancelled:
+                    timer.callback(*timer.args)
+
+    def next_deadline(self):
+        """
+        Return the time by which advance() should next be called, or None
+        if nothing is scheduled.
+        """
+        ticks = self._next_tick()
+        if ticks is None:
+            return None
+        return ticks * self.resolution
+
+    def _next_tick(self):
+        """
+        Return the next tick at which a timer is due or timers have to
+        cascade down from a higher level.
+        """
+        if not self.count:
+            return None
+        mask = self.SLOTS - 1
+        if self.current & mask == 0:
+            ## A cascade may be due before anything else
+            return self.current
+        for level in range(self.LEVELS):
+            shift = self.SLOT_BITS * level
+            base = self.current >> shift
+            index = base & mask
+            wheel = self.wheels[level]
+            ## The current slot of a higher level has already cascaded
+            start = index if level == 0 else index + 1
+            for slot in range(start, self.SLOTS):
+                if wheel[slot]:
+                    return (base + slot - index) << shift
+            ## Slots behind us belong to the next turn of this level, which
+            ## starts with a cascade from the level above
+            if any(wheel[:start]):
+                return (base + self.SLOTS - index) << shift
+        return None
+
+
+#--[ Polling Backends ]--------------------------------------------------------
+
+## Backend name -> selectors class name.  Not every platform has every one.
+BACKENDS = {
+    'select'  : 'SelectSelector',
+    'poll'    : 'PollSelector',
+    'epoll'   : 'EpollSelector',
+    'kqueue'  : 'KqueueSelector',
+    'devpoll' : 'DevpollSelector',
+    }
+
+def make_selector(backend=None):
+    """
+    Return a selectors.BaseSelector for the named backend.  With no backend
+    the most efficient one available on this platform is used (epoll on
+    Linux, kqueue on the BSDs and OS X) falling back to plain select().
+    """
+    if backend is None:
+        return selectors.DefaultSelector()
+    try:
+        selector_class = getattr(selectors, BACKENDS[backend])
+    except (KeyError, AttributeError):
+        raise ValueError("Polling backend '{}' is not available".format(backend))
+    return selector_class()
+
+
+#--[ Server Metrics ]----------------------------------------------------------
+
+## Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+BYTES_BUCKETS = (0, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+class Histogram(object):
+    """
+    Count observations into buckets with fixed upper bounds.
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # The last one is +Inf
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Return the upper bound of the bucket holding the q quantile, None
+        when there is nothing to go on or it is beyond the last bound.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        """
+        Return a dict of the count, sum, median, 99th percentile and the
+        cumulative bucket counts keyed by upper bound.
+        """
+        buckets = collections.OrderedDict()
+        for bound, total in zip(self.bounds + ('+Inf',),
+                itertools.accumulate(self.counts)):
+            buckets[bound] = total
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': buckets,
+            }
+
+
+class ServerMetrics(object):
+    """
+    Counters and histograms a TelnetServer keeps about its poll loop.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.polls = 0
+        self.accepts = 0
+        self.disconnects = 0
+        self.refused = 0
+        ## Counts over the last whole second, see rotate()
+        self.accepts_per_second = 0
+        self.disconnects_per_second = 0
+        self.last_accepts = 0
+        self.last_disconnects = 0
+        self.poll_seconds = Histogram(SECONDS_BUCKETS)
+        self.ready_sockets = Histogram(COUNT_BUCKETS)
+        self.send_queue_bytes = Histogram(BYTES_BUCKETS)
+        self.parse_seconds = Histogram(SECONDS_BUCKETS)
+        self.callback_seconds = Histogram(SECONDS_BUCKETS)
+        self.callback_clock = 0.0   # Total seconds spent in callbacks
+
+    def timed(self, callback):
+        """
+        Wrap callback so that the time spent in it is recorded.
+        """
+        if callback is None:
+            return None
+        @functools.wraps(callback)
+        def timed_callback(*args):
+            start = time.perf_counter()
+            try:
+                return callback(*args)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.callback_clock += elapsed
+                self.callback_seconds.observe(elapsed)
+        return timed_callback
+
+    def rotate(self):
+        """
+        Called once a second to work out the per second rates.
+        """
+        self.accepts_per_second = self.accepts - self.last_accepts
+        self.disconnects_per_second = self.disconnects - self.last_disconnects
+        self.last_accepts = self.accepts
+        self.last_disconnects = self.disconnects
+
+    def snapshot(self):
+        """
+        Return the metrics as a dict.
+        """
+        return {
+            'uptime': time.time() - self.started,
+            'polls': self.polls,
+            'accepts': self.accepts,
+            'disconnects': self.disconnects,
+            'refused': self.refused,
+            'accepts_per_second': self.accepts_per_second,
+            'disconnects_per_second': self.disconnects_per_second,
+            'poll_seconds': self.poll_seconds.snapshot(),
+            'ready_sockets': self.ready_sockets.snapshot(),
+            'send_queue_bytes': self.send_queue_bytes.snapshot(),
+            'parse_seconds': self.parse_seconds.snapshot(),
+            'callback_seconds': self.callback_seconds.snapshot(),
+            }
+
+
+## Fields of stats() that only ever go up
+METRIC_COUNTERS = ('polls', 'accepts', 'disconnects', 'refused',
+    'bytes_dropped')
+
+def prometheus_text(stats, prefix='miniboa'):
+    """
+    Format a TelnetServer.stats() snapshot in the Prometheus text
+    exposition format.
+    """
+    lines = []
+    for name, value in sorted(stats.items()):
+        metric = '{}_{}'.format(prefix, name)
+        if isinstance(value, dict):
+            lines.append('# TYPE {} histogram'.format(metric))
+            for bound, total in value['buckets'].items():
+                lines.append('{}_bucket{{le="{}"}} {}'.format(metric, bound, total))
+            lines.append('{}_sum {}'.format(metric, value['sum']))
+            lines.append('{}_count {}'.format(metric, value['count']))
+        else:
+            kind = 'counter' if name in METRIC_COUNTERS else 'gauge'
+            if kind == 'counter':
+                metric += '_total'
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            lines.append('{} {}'.format(metric, value))
+    return '\n'.join(lines) + '\n'
+
+
+#--[ Pre-rendered Messages ]---------------------------------------------------
+
+class Message(object):
+    """
+    Text with caret codes that is sent many times, such as a room
+    description.  It is rendered, and wrapped if asked for, once for each
+    distinct terminal it is sent to and the bytes are kept for next time.
+    """
+    def __init__(self, text, wrap=False):
+        self.text = text
+        self.wrap = wrap
+        self.rendered = {}      # Variant key -> bytes ready to send
+
+    def key(self, client):
+        """
+        Return the key of the variant of this message the client gets.
+        """
+        if self.wrap:
+            return (client.render_key(), client.columns)
+        return client.render_key()
+
+    def render(self, client):
+        """
+        Return the bytes of this message for the client's terminal.
+        """
+        key = self.key(client)
+        data = self.rendered.get(key)
+        if data is None:
+            text = self.text
+            if self.wrap:
+                text = ''.join(line + '\n' for line in iter_wrap(text,
+                    client.columns))
+            data = self.rendered[key] = client.render(text)
+        return data
+
+    def variants(self):
+        """
+        Return how many variants of this message have been rendered.
+        """
+        return len(self.rendered)
 
 
 #--[ Telnet Server ]-----------------------------------------------------------
 
+def broadcast(clients, text, predicate=None):
+    """
+    Send text with caret codes, or a Message, to every active client in
+    clients for which predicate(client), if given, is true.  Text is
+    rendered once for each distinct render_key() and the same bytes are
+    queued for everyone.
+    """
+    if not text:
+        return
+    if isinstance(text, Message):
+        for client in clients:
+            if client.active and (predicate is None or predicate(client)):
+                client._send_bytes(text.render(client))
+        return
+    rendered = {}
+    for client in clients:
+        if not client.active or (predicate is not None and not predicate(client)):
+            continue
+        key = client.render_key()
+        data = rendered.get(key)
+        if data is None:
+            data = rendered[key] = client.render(text)
+        client._send_bytes(data)
+
+class RateLimiter(object):
+    """
+    A token bucket per address: each address may do something burst times
+    at once and rate times a second after that.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}       # Address -> [tokens, time they were counted]
+
+    def allow(self, address, now):
+        """
+        Take a token from the address' bucket, returns False if it is empty.
+        """
+        bucket = self.buckets.get(address)
+        if bucket is None:
+            self.buckets[address] = [self.burst - 1, now]
+            return True
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def prune(self, now):
+        """
+        Forget the addresses whose buckets have filled up again.
+        """
+        burst = self.burst
+        rate = self.rate
+        full = [address for address, (tokens, when) in self.buckets.items()
+            if tokens + (now - when) * rate >= burst]
+        for address in full:
+            del self.buckets[address]
+
+
+## TelnetServer attributes holding callbacks, see ServerMetrics.timed()
+SERVER_CALLBACKS = ('on_connect', 'on_disconnect', 'on_idle', 'on_command',
+    'on_autosense_complete', 'on_resize', 'on_drain')
+
 ## Default connection handler
 def _on_connect(client):
     """
@@ -899,7 +2274,15 @@ class TelnetServer(object):
     Poll sockets for new connections and sending/receiving data from clients.
     """
     def __init__(self, port=7777, address='', on_connect=_on_connect,
-            on_disconnect=_on_disconnect, timeout=0.1):
+            on_disconnect=_on_disconnect, timeout=0.1, backend=None,
+            max_connections=None, tcp_nodelay=False, reuse_port=False,
+            backlog=BACKLOG, max_accepts=MAX_ACCEPTS, accept_rate=None,
+            accept_burst=None,
+            bus=None, idle_timeout=None, on_idle=None, on_command=None,
+            on_autosense_complete=None, on_resize=None, on_drain=None,
+            max_output_bytes=None, metrics=False, metrics_port=None,
+            metrics_address='127.0.0.1', compress_level=None, charsets=None,
+            executor=None, client_class=TelnetClient):
         """
         Create a new Telnet Server.
 
@@ -918,7 +2301,89 @@ class TelnetServer(object):
             to False.
 
         timeout -- amount of time that Poll() will wait from user input
-            before returning.  Also frees a slice of CPU time.
+            before returning.  Also frees a slice of CPU time.  Poll() returns
+            sooner when a timer is due; None waits for input or a timer.
+
+        backend -- name of the readiness backend to use; one of 'select',
+            'poll', 'epoll', 'kqueue' or 'devpoll'.  Defaults to the best
+            one available on this platform.
+
+        max_connections -- refuse connections beyond this number.  Defaults
+            to MAX_CONNECTIONS for the 'select' backend, which cannot watch
+            more file descriptors than that, and to no limit otherwise.
+
+        tcp_nodelay -- disable Nagle's algorithm on client sockets.  Output
+            is already coalesced into one write per client per poll, so
+            this mostly trades a little bandwidth for lower latency.
+
+        reuse_port -- set SO_REUSEPORT so that several processes can listen
+            on the same port, with the kernel sharing connections out
+            between them.  See run_workers().
+
+        backlog -- connections the kernel queues up for us to accept.
+
+        max_accepts -- most new connections accepted in one poll().
+
+        accept_rate -- connections per second that any one address may
+            open.  Others are closed before a client is created for them.
+            None does not limit the rate.
+
+        accept_burst -- connections an address may open at once before
+            accept_rate applies.  Defaults to accept_rate, or 1.
+
+        bus -- a MessageBus connecting this server to the other workers of a
+            run_workers() cluster.  Broadcasts to all clients and send_to()
+            then reach clients held by the other workers too.
+
+        idle_timeout -- seconds without input after which on_idle is called
+            with the client.
+
+        on_idle -- function to call with idle clients, by default they are
+            deactivated.
+
+        on_command -- function to call with the client and each line of
+            input as soon as it is received.  When set, lines are no longer
+            queued for get_command().
+
+        on_autosense_complete -- function to call with a client once the
+            negotiations started by detect_term_caps() have completed or
+            timed out.
+
+        on_resize -- function to call with a client when it reports a new
+            window size.
+
+        on_drain -- function to call with a client when its output queue
+            drains to its low watermark after going over its high watermark,
+            see TelnetClient.is_writable().
+
+        max_output_bytes -- budget for the output queued for all clients.
+            Once it is used up, clients with more than their low watermark
+            queued are treated as if over their own budget.
+
+        metrics -- record histograms of the poll loop's timings for stats().
+            The callbacks above are timed as passed in; ones assigned to the
+            server later are not.
+
+        metrics_port -- serve stats() in the Prometheus text format over
+            HTTP on this port.  Implies metrics.
+
+        metrics_address -- address for metrics_port to listen on, by default
+            only reachable from this host.
+
+        compress_level -- offer new clients MCCP2 compression of their
+            output at this zlib level, 1 to 9.  None does not offer it.
+
+        charsets -- offer new clients these character sets, such as
+            CHARSETS, with CHARSET negotiation.  Until one is agreed on, or
+            if this is None, text is sent and received as DEFAULT_ENCODING.
+
+        executor -- concurrent.futures executor that submit() runs slow
+            handlers in.  By default a thread pool is created when first
+            needed.
+
+        client_class -- class of the clients created for new connections,
+            a subclass of TelnetClient that can carry the application's own
+            attributes.
         """
 
         self.port = port
@@ -926,23 +2391,96 @@ class TelnetServer(object):
         self.on_connect = on_connect
         self.on_disconnect = on_disconnect
         self.timeout = timeout
+        self.tcp_nodelay = tcp_nodelay
+        self.idle_timeout = idle_timeout
+        self.on_idle = on_idle
+        self.on_command = on_command
+        self.on_autosense_complete = on_autosense_complete
+        self.on_resize = on_resize
+        self.on_drain = on_drain
+        self.max_output_bytes = max_output_bytes
+        self.compress_level = compress_level
+        self.charsets = charsets
+        self.executor = executor
+        self.client_class = client_class
+        self.max_accepts = max_accepts
+        self.output_bytes = 0       # Bytes queued for all clients
+        self.bytes_dropped = 0      # Bytes of output discarded for all clients
+        self.timers = TimerWheel()
+
+        ## Jobs submitted for each client, only the first one is running
+        self.jobs = {}
+        ## Calls from other threads, run by poll() when woken up through
+        ## the socket pair
+        self.threadsafe_calls = collections.deque()
+        self.wakeup_socket, self.wakeup_sender = socket.socketpair()
+        self.wakeup_socket.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        self.wakeup_fileno = self.wakeup_socket.fileno()
+
+        self.metrics = None
+        if metrics or metrics_port is not None:
+            self.metrics = ServerMetrics()
+            for name in SERVER_CALLBACKS:
+                setattr(self, name, self.metrics.timed(getattr(self, name)))
+            self.call_later(1, self._rotate_metrics)
 
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         try:
             server_socket.bind((address, port))
-            server_socket.listen(5)
-        except socket.err as err:
+            server_socket.listen(backlog)
+        except socket.error as err:
             logging.critical("Unable to create the server socket: " + str(err))
             raise
+        server_socket.setblocking(False)
 
         self.server_socket = server_socket
         self.server_fileno = server_socket.fileno()
 
+        self.selector = make_selector(backend)
+        self.selector.register(self.server_fileno, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_fileno, selectors.EVENT_READ)
+
+        self.bus = bus
+        self.bus_fileno = None
+        if bus is not None:
+            self.bus_fileno = bus.fileno()
+            self.selector.register(self.bus_fileno, selectors.EVENT_READ)
+
+        self.metrics_socket = None
+        self.metrics_fileno = None
+        if metrics_port is not None:
+            metrics_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            metrics_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            metrics_socket.bind((metrics_address, metrics_port))
+            metrics_socket.listen(5)
+            metrics_socket.setblocking(False)
+            self.metrics_socket = metrics_socket
+            self.metrics_fileno = metrics_socket.fileno()
+            self.selector.register(self.metrics_fileno, selectors.EVENT_READ)
+
+        if isinstance(self.selector, selectors.SelectSelector):
+            if max_connections is None or max_connections > MAX_CONNECTIONS:
+                max_connections = MAX_CONNECTIONS
+        self.max_connections = max_connections
+
         ## Dictionary of active clients,
         ## key = file descriptor, value = TelnetClient instance
         self.clients = {}
+
+        ## Clients deactivated since the last poll, see _note_inactive()
+        self.inactive_clients = []
+
+        self.rate_limiter = None
+        if accept_rate is not None:
+            if accept_burst is None:
+                accept_burst = max(1, accept_rate)
+            self.rate_limiter = RateLimiter(accept_rate, accept_burst)
+            self.call_later(RATE_LIMIT_PRUNE, self._prune_rate_limiter)
     
     def client_count(self):
         """
@@ -956,78 +2494,771 @@ class TelnetServer(object):
         """
         return self.clients.values()
 
+    def broadcast(self, text, clients=None, predicate=None):
+        """
+        Send text with caret codes to many clients, by default every client
+        connected, including those of other workers if we have a bus.  See
+        broadcast().
+        """
+        if clients is None:
+            clients = self.clients.values()
+            if self.bus is not None and predicate is None:
+                if isinstance(text, Message):
+                    self.bus.publish('message', text.text, text.wrap)
+                else:
+                    self.bus.publish('broadcast', text)
+        broadcast(clients, text, predicate)
 
-    def poll(self):
+    def send_to(self, addrport, text):
         """
-        Perform a non-blocking scan of recv and send states on the server
-        and client connection sockets.  Process new connection requests,
-        read incomming data, and send outgoing data.  Sends and receives may
-        be partial.
+        Send text with caret codes to the client with the given addrport(),
+        wherever in the cluster it is connected.
         """
-        ## Build a list of connections to test for receive data pending
-        recv_list = [self.server_fileno]    # always add the server
-        
-        del_list = [] # list of clients to delete after polling
-        
         for client in self.clients.values():
+            if client.addrport() == addrport:
+                client.send_cc(text)
+                return
+        if self.bus is not None:
+            self.bus.publish('send_to', addrport, text)
+
+    def call_at(self, when, callback, *args):
+        """
+        Call callback(*args) from poll() once time.time() reaches when.
+        Returns a Timer that can be cancelled.
+        """
+        return self.timers.schedule(when, callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Call callback(*args) from poll() in delay seconds.  Returns a Timer
+        that can be cancelled.
+        """
+        return self.timers.schedule(time.time() + delay, callback, *args)
+
+    def stats(self):
+        """
+        Return a snapshot of the server's state as a dict.  With metrics
+        enabled this includes the counters and histograms of the poll loop.
+        """
+        stats = {
+            'clients': len(self.clients),
+            'timers': self.timers.count,
+            'output_bytes': self.output_bytes,
+            'bytes_dropped': self.bytes_dropped,
+            }
+        if self.metrics is not None:
+            stats.update(self.metrics.snapshot())
+        return stats
+
+    def _prune_rate_limiter(self):
+        self.rate_limiter.prune(time.time())
+        self.call_later(RATE_LIMIT_PRUNE, self._prune_rate_limiter)
+
+    def _rotate_metrics(self):
+        self.metrics.rotate()
+        self.call_later(1, self._rotate_metrics)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Call callback(*args) from the next poll().  Unlike everything else
+        on the server this may be called from any thread, and it wakes up a
+        poll() that is waiting.
+        """
+        self.threadsafe_calls.append((callback, args))
+        try:
+            self.wakeup_sender.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            ## Full of wakeups already
+            pass
+
+    def _run_threadsafe_calls(self):
+        try:
+            while self.wakeup_socket.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        calls = self.threadsafe_calls
+        while calls:
+            callback, args = calls.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                logging.exception("Threadsafe call {} failed".format(
+                    getattr(callback, '__name__', callback)))
+
+    def submit(self, client, func, *args, callback=None):
+        """
+        Run func(*args) in the executor so that poll() carries on meanwhile,
+        for handlers that wait on disk or a database.  When it returns,
+        poll() calls callback(client, result) or, without a callback, sends
+        the result to the client with send_cc() if it is a string.
+
+        Jobs for the same client run one after the other, in the order they
+        were submitted, so their replies never overtake each other.  Those
+        still waiting when the client disconnects are dropped.
+        """
+        jobs = self.jobs.get(client)
+        if jobs is None:
+            jobs = self.jobs[client] = collections.deque()
+        jobs.append((func, args, callback))
+        if len(jobs) == 1:
+            self._start_job(client)
+
+    def _start_job(self, client):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor()
+        func, args, callback = self.jobs[client][0]
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(functools.partial(self.call_soon_threadsafe,
+            self._job_done, client))
+
+    def _job_done(self, client, future):
+        """
+        Deliver the result of a client's job and start its next one.
+        """
+        jobs = self.jobs.get(client)
+        if jobs is None:
+            return
+        func, args, callback = jobs.popleft()
+        try:
             if client.active:
-                recv_list.append(client.fileno)
+                try:
+                    result = future.result()
+                except Exception:
+                    logging.exception("Job {} for {} failed".format(
+                        getattr(func, '__name__', func), client.addrport()))
+                else:
+                    if callback is not None:
+                        callback(client, result)
+                    elif isinstance(result, str):
+                        client.send_cc(result)
+        finally:
+            ## A failing callback must not stall the client's queue
+            if jobs and client.active:
+                self._start_job(client)
             else:
-                self.on_disconnect(client)
-                del_list.append(client.fileno)
+                del self.jobs[client]
 
-        ## Delete inactive connections from the dictionary
-        for client in del_list:
-            del self.clients[client]
+    def _check_idle(self, client):
+        """
+        Idle timer callback.  Input does not reset the timer, instead it is
+        rescheduled here if the client typed something since it was set.
+        """
+        if not client.active or self.clients.get(client.fileno) is not client:
+            return
+        deadline = client.last_input_time + self.idle_timeout
+        if time.time() < deadline:
+            client.idle_timer = self.call_at(deadline, self._check_idle, client)
+        elif self.on_idle is not None:
+            self.on_idle(client)
+        else:
+            client.deactivate()
 
-        ## Build a list of connections that need to send data
-        send_list = []
-        for client in self.clients.values():
-            if client.send_pending:
-                send_list.append(client.fileno)
+    def _bus_receive(self):
+        """
+        Deliver messages published by the other workers on the bus.
+        """
+        for message in self.bus.receive():
+            kind = message[0]
+            if kind == 'broadcast':
+                broadcast(self.clients.values(), message[1])
+            elif kind == 'message':
+                broadcast(self.clients.values(), Message(message[1], message[2]))
+            elif kind == 'send_to':
+                for client in self.clients.values():
+                    if client.addrport() == message[1]:
+                        client.send_cc(message[2])
+                        break
+            else:
+                logging.warning("Unknown bus message '{}'".format(kind))
 
-        ## Get active socket file descriptors from select.select()
+    def poll(self):
+        """
+        Perform a non-blocking scan of recv and send states on the server
+        and client connection sockets.  Process new connection requests,
+        read incomming data, and send outgoing data.  Sends and receives may
+        be partial.
+        """
+        metrics = self.metrics
+
+        ## Drop the connections that were deactivated since the last poll
+        inactive, self.inactive_clients = self.inactive_clients, []
+        for client in inactive:
+            if client.active or self.clients.get(client.fileno) is not client:
+                continue
+            if metrics is not None:
+                metrics.disconnects += 1
+            self.on_disconnect(client)
+            client.discard_output()
+            client._cancel_timers()
+            self.selector.unregister(client.fileno)
+            del self.clients[client.fileno]
+            client.sock.close()
+            ## Forget its waiting jobs, the running one finds them gone
+            self.jobs.pop(client, None)
+
+        ## Don't sleep past the next timer
+        timeout = self.timeout
+        deadline = self.timers.next_deadline()
+        if deadline is not None:
+            timeout = max(0, deadline - time.time())
+            if self.timeout is not None:
+                timeout = min(timeout, self.timeout)
+
+        ## Get ready socket file descriptors from the selector
         try:
-            rlist, slist, elist = select.select(recv_list, send_list, [],
-                self.timeout)
-        except select.error as err:
-            ## If we can't even use select(), game over man, game over
-            logging.critical("SELECT socket error '{}:{}'".format(err[0], err[1]))
+            ready = self.selector.select(timeout)
+        except OSError as err:
+            ## If we can't even poll, game over man, game over
+            logging.critical("SELECT socket error '{}'".format(err))
             raise
 
-        ## Process socket file descriptors with data to recieve
-        for sock_fileno in rlist:
-
-            ## If it's coming from the server's socket then this is a new connection request.
-            if sock_fileno == self.server_fileno:
-
-                try:
-                    sock, addr_tup = self.server_socket.accept()
-                except socket.error as err:
-                    logging.error("ACCEPT socket error '{}:{}'.".format(err[0], err[1]))
-                    continue
+        if metrics is not None:
+            start = time.perf_counter()
+            metrics.polls += 1
+            metrics.ready_sockets.observe(len(ready))
 
-                #Check for maximum connections
-                if self.client_count() >= MAX_CONNECTIONS:
-                    logging.warning("Refusing new connection, maximum already in use.")
-                    sock.close()
-                    continue
+        send_list = []
 
-                ## Create the client instance
-                new_client = TelnetClient(sock, addr_tup)
-                
-                ## Add the connection to our dictionary and call handler
-                self.clients[new_client.fileno] = new_client
-                self.on_connect(new_client)
+        ## Process socket file descriptors with data to recieve
+        for key, events in ready:
 
-            else:
+            ## If it's coming from the server's socket then this is a new connection request.
+            if key.fd == self.server_fileno:
+                self._accept()
+                continue
+
+            ## Or a message from another worker process
+            if key.fd == self.bus_fileno:
+                self._bus_receive()
+                continue
+
+            ## Or another thread waking us up
+            if key.fd == self.wakeup_fileno:
+                self._run_threadsafe_calls()
+                continue
+
+            ## Or a scrape of our metrics
+            if key.fd == self.metrics_fileno:
+                self._metrics_accept()
+                continue
+
+            if events & selectors.EVENT_READ and key.data.active:
                 ## Call the connection's recieve method
                 try:
-                    self.clients[sock_fileno].socket_recv()
+                    if metrics is None:
+                        key.data.socket_recv()
+                    else:
+                        ## Parse time leaves out the callbacks it triggers
+                        clock = metrics.callback_clock
+                        begin = time.perf_counter()
+                        key.data.socket_recv()
+                        metrics.parse_seconds.observe(time.perf_counter()
+                            - begin - (metrics.callback_clock - clock))
                 except ConnectionLost:
-                    self.clients[sock_fileno].deactivate()
+                    key.data.deactivate()
+
+            if events & selectors.EVENT_WRITE:
+                send_list.append(key.data)
 
         ## Process sockets with data to send
-        for sock_fileno in slist:
+        for client in send_list:
+            if metrics is not None and isinstance(client, TelnetClient):
+                metrics.send_queue_bytes.observe(client.send_queue_size)
             ## Call the connection's send method
-            self.clients[sock_fileno].socket_send()
\ No newline at end of file
+            client.socket_send()
+
+        ## Run the timers that are due
+        self.timers.advance()
+
+        if metrics is not None:
+            metrics.poll_seconds.observe(time.perf_counter() - start)
+
+    def _accept(self):
+        """
+        Accept the new connections waiting on the server socket, up to
+        max_accepts of them.
+        """
+        limiter = self.rate_limiter
+        for count in range(self.max_accepts):
+            try:
+                sock, addr_tup = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error as err:
+                logging.error("ACCEPT socket error '{}'.".format(err))
+                return
+
+            ## Turn away addresses connecting too often before doing any work
+            if limiter is not None and not limiter.allow(addr_tup[0], time.time()):
+                logging.debug("Refusing new connection from {}, rate limited.".format(addr_tup[0]))
+                sock.close()
+                if self.metrics is not None:
+                    self.metrics.refused += 1
+                continue
+
+            self._add_connection(sock, addr_tup)
+
+    def _add_connection(self, sock, addr_tup):
+        """
+        Create a TelnetClient for a newly accepted connection.
+        """
+        #Check for maximum connections
+        if (self.max_connections is not None and
+                self.client_count() >= self.max_connections):
+            logging.warning("Refusing new connection, maximum already in use.")
+            sock.close()
+            if self.metrics is not None:
+                self.metrics.refused += 1
+            return
+
+        sock.setblocking(False)
+        if self.tcp_nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        ## Create the client instance
+        new_client = self.client_class(sock, addr_tup)
+
+        ## Add the connection to our dictionary and call handler
+        self.clients[new_client.fileno] = new_client
+        self.selector.register(new_client.fileno, selectors.EVENT_READ,
+            new_client)
+        new_client.server = self
+        if self.idle_timeout is not None:
+            new_client.idle_timer = self.call_later(self.idle_timeout,
+                self._check_idle, new_client)
+        if self.metrics is not None:
+            self.metrics.accepts += 1
+        if self.compress_level is not None:
+            new_client.request_compression(self.compress_level)
+        if self.charsets is not None:
+            new_client.request_charset(self.charsets)
+        self.on_connect(new_client)
+
+    def _metrics_accept(self):
+        """
+        Accept a connection to the metrics port.  The request is read and
+        answered by a MetricsRequest from the poll loop like any client.
+        """
+        try:
+            sock, addr_tup = self.metrics_socket.accept()
+        except socket.error as err:
+            logging.error("ACCEPT metrics socket error '{}'.".format(err))
+            return
+        sock.setblocking(False)
+        request = MetricsRequest(sock, self)
+        self.selector.register(sock.fileno(), selectors.EVENT_READ, request)
+
+    def _note_inactive(self, client):
+        """
+        Called by a client when it is deactivated, queues it for removal on
+        the next poll.
+        """
+        self.inactive_clients.append(client)
+
+    def _note_send_pending(self, client):
+        """
+        Called by a client when its send_pending flag flips, so that we only
+        watch for writability while it has data to send.
+        """
+        if self.clients.get(client.fileno) is not client:
+            return
+        events = selectors.EVENT_READ
+        if client.send_pending:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(client.fileno, events, client)
+
+
+class MetricsRequest(object):
+    """
+    A connection to a TelnetServer's metrics port.  Whatever is asked for,
+    the answer is the server's stats() as Prometheus text, sent as the
+    socket takes it so a large one never blocks the poll loop.
+    """
+    def __init__(self, sock, server):
+        self.sock = sock
+        self.server = server
+        self.active = True
+        self.request = b''
+        self.response = None
+
+    def socket_recv(self):
+        try:
+            data = self.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b''
+        self.request += data
+        if data and b'\r\n\r\n' not in self.request and len(self.request) < 8192:
+            return
+        if not data:
+            self._close()
+            return
+        body = prometheus_text(self.server.stats()).encode('ascii')
+        self.response = memoryview(b'HTTP/1.0 200 OK\r\n'
+            b'Content-Type: text/plain; version=0.0.4\r\n'
+            b'Content-Length: ' + str(len(body)).encode('ascii') +
+            b'\r\n\r\n' + body)
+        self.server.selector.modify(self.sock.fileno(), selectors.EVENT_WRITE,
+            self)
+        self.socket_send()
+
+    def socket_send(self):
+        """
+        Send what the socket takes of the response, closing once it is all
+        gone.
+        """
+        try:
+            sent = self.sock.send(self.response)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error as err:
+            logging.warning("Unable to send metrics '{}'".format(err))
+            self._close()
+            return
+        self.response = self.response[sent:]
+        if not self.response:
+            self._close()
+
+    def _close(self):
+        self.active = False
+        self.server.selector.unregister(self.sock.fileno())
+        self.sock.close()
+
+
+#--[ Worker Processes ]--------------------------------------------------------
+
+class MessageBus(object):
+    """
+    Carries messages between the worker processes started by run_workers(),
+    over one UNIX datagram socket per worker.
+    """
+    def __init__(self, paths, index):
+        """
+        paths -- socket paths of every worker, ours included.
+
+        index -- the position of our own path in paths.
+        """
+        self.paths = paths
+        self.index = index
+        if os.path.exists(paths[index]):
+            os.unlink(paths[index])
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(paths[index])
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def publish(self, kind, *args):
+        """
+        Send a message to every other worker.  Messages are lost if a worker
+        is down or too far behind to take them.
+        """
+        data = json.dumps([kind] + list(args)).encode('utf-8')
+        if len(data) > BUS_MAX_MESSAGE:
+            logging.error("Bus message '{}' too long, dropped".format(kind))
+            return
+        for index, path in enumerate(self.paths):
+            if index == self.index:
+                continue
+            try:
+                self.sock.sendto(data, path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                pass
+            except BlockingIOError:
+                logging.warning("Worker {} is not keeping up, bus message dropped".format(index))
+            except socket.error as err:
+                logging.error("BUS socket error '{}' to worker {}".format(err, index))
+
+    def receive(self):
+        """
+        Return a list of the messages waiting for us.
+        """
+        messages = []
+        while True:
+            try:
+                data = self.sock.recv(BUS_MAX_MESSAGE)
+            except (BlockingIOError, InterruptedError):
+                break
+            try:
+                message = json.loads(data.decode('utf-8'))
+            except ValueError as err:
+                logging.warning("Dropped a malformed bus message: {}".format(err))
+                continue
+            if not isinstance(message, list) or not message:
+                logging.warning("Dropped a bus message that is not a list")
+                continue
+            messages.append(message)
+        return messages
+
+    def close(self):
+        self.sock.close()
+
+
+def _worker_main(target, paths, index):
+    """
+    Entry point of a worker process.
+    """
+    bus = MessageBus(paths, index)
+    try:
+        target(bus)
+    finally:
+        bus.close()
+
+
+def run_workers(target, count=None):
+    """
+    Run target(bus) in count worker processes, one per CPU by default, and
+    restart any that die with an error.  Each worker would normally create
+    a TelnetServer(reuse_port=True, bus=bus) and poll() it, so that the
+    kernel spreads new connections over the workers.  Returns once every
+    worker has exited cleanly, or on KeyboardInterrupt.
+    """
+    if count is None:
+        count = os.cpu_count() or 1
+    directory = tempfile.mkdtemp(prefix='miniboa-')
+    paths = [os.path.join(directory, 'worker-{}.sock'.format(index))
+        for index in range(count)]
+
+    def start(index):
+        process = multiprocessing.Process(target=_worker_main,
+            args=(target, paths, index))
+        process.start()
+        return process
+
+    workers = dict((index, start(index)) for index in range(count))
+    try:
+        while workers:
+            sentinels = [process.sentinel for process in workers.values()]
+            multiprocessing.connection.wait(sentinels)
+            for index, process in list(workers.items()):
+                if process.is_alive():
+                    continue
+                if process.exitcode == 0:
+                    del workers[index]
+                else:
+                    logging.error("Worker {} died with exit code {}, restarting".format(
+                        index, process.exitcode))
+                    workers[index] = start(index)
+    except KeyboardInterrupt:
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            process.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+#--[ Asyncio Telnet Server ]---------------------------------------------------
+
+class TelnetProtocol(asyncio.Protocol):
+    """
+    Adapts a TelnetClient to an asyncio transport.  Received data is fed to
+    the client and whatever it queues for sending is written to the
+    transport on the next pass of the event loop.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.client = None
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        addr_tup = transport.get_extra_info('peername')
+        self.client = self.server.client_class(sock, addr_tup)
+        self.client.server = self.server
+        ## Leave output the transport can't take in the client's queue,
+        ## where its budgets apply
+        transport.set_write_buffer_limits(self.client.high_watermark,
+            self.client.low_watermark)
+        self.server._add_client(self)
+
+    def data_received(self, data):
+        client = self.client
+        try:
+            client.feed(data)
+        except ConnectionLost:
+            client.deactivate()
+            return
+        for cmd in client.get_commands():
+            self.server.command_queue.put_nowait((client, cmd))
+
+    def connection_lost(self, exc):
+        self.client.active = False
+        self.server._remove_client(self)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+
+    def flush(self):
+        """
+        Write the client's pending output to the transport.
+        """
+        if (self.client.send_pending and not self.paused and
+                not self.transport.is_closing()):
+            self.transport.write(self.client._take_send_data())
+
+
+class AsyncTelnetServer(object):
+    """
+    Telnet server running on an asyncio event loop.  Uses the same
+    TelnetClient class as TelnetServer, but instead of calling poll() in a
+    loop, await start() and read lines with:
+
+        async for client, command in server.commands():
+            ...
+    """
+    def __init__(self, port=7777, address='', on_connect=_on_connect,
+            on_disconnect=_on_disconnect, on_command=None,
+            on_autosense_complete=None, on_resize=None, on_drain=None,
+            max_output_bytes=None, compress_level=None, charsets=None,
+            client_class=TelnetClient):
+        """
+        Create a new asyncio Telnet Server.  See TelnetServer for a
+        description of the arguments; with on_command set, commands() is
+        not used.  Nothing is listening until start() has been awaited.
+        """
+        self.port = port
+        self.address = address
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.on_command = on_command
+        self.on_autosense_complete = on_autosense_complete
+        self.on_resize = on_resize
+        self.on_drain = on_drain
+        self.max_output_bytes = max_output_bytes
+        self.compress_level = compress_level
+        self.charsets = charsets
+        self.client_class = client_class
+        self.output_bytes = 0       # Bytes queued for all clients
+        self.bytes_dropped = 0      # Bytes of output discarded for all clients
+
+        self.loop = None
+        self.server = None
+        self.command_queue = asyncio.Queue()
+
+        ## Dictionary of active clients,
+        ## key = TelnetClient instance, value = TelnetProtocol instance
+        self.clients = {}
+
+    async def start(self):
+        """
+        Start listening for connections on the running event loop.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.server = await self.loop.create_server(lambda: TelnetProtocol(self),
+            self.address or None, self.port, family=socket.AF_INET,
+            reuse_address=True)
+        if self.port == 0:
+            self.port = self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        """
+        Stop listening, drop all connections and end commands().
+        """
+        if self.server is not None:
+            self.server.close()
+        for client in list(self.clients):
+            client.deactivate()
+        self.command_queue.put_nowait(None)
+
+    async def wait_closed(self):
+        """
+        Wait until the listening socket is closed.
+        """
+        if self.server is not None:
+            await self.server.wait_closed()
+
+    def client_count(self):
+        """
+        Returns the number of active connections.
+        """
+        return len(self.clients)
+
+    def client_list(self):
+        """
+        Returns a list of connected clients.
+        """
+        return self.clients.keys()
+
+    def broadcast(self, text, clients=None, predicate=None):
+        """
+        Send text with caret codes to many clients, by default every client
+        connected.  See broadcast().
+        """
+        if clients is None:
+            clients = self.clients.keys()
+        broadcast(clients, text, predicate)
+
+    async def commands(self):
+        """
+        Asynchronous iterator of (client, command) tuples, one for every line
+        of input received.  Ends when the server is closed.
+        """
+        while True:
+            item = await self.command_queue.get()
+            if item is None:
+                return
+            yield item
+
+    def call_at(self, when, callback, *args):
+        """
+        Call callback(*args) once time.time() reaches when.  Returns a
+        handle that can be cancelled.
+        """
+        return self.loop.call_later(max(0, when - time.time()), callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Call callback(*args) in delay seconds.  Returns a handle that can be
+        cancelled.
+        """
+        return self.loop.call_later(delay, callback, *args)
+
+    def _add_client(self, protocol):
+        self.clients[protocol.client] = protocol
+        if self.compress_level is not None:
+            protocol.client.request_compression(self.compress_level)
+        if self.charsets is not None:
+            protocol.client.request_charset(self.charsets)
+        self.on_connect(protocol.client)
+
+    def _remove_client(self, protocol):
+        if self.clients.pop(protocol.client, None) is not None:
+            self.on_disconnect(protocol.client)
+            protocol.client.discard_output()
+            protocol.client._cancel_timers()
+            ## The socket belongs to the transport, make sure it is closed
+            protocol.transport.abort()
+
+    def _note_inactive(self, client):
+        """
+        Called by a client when it is deactivated, flush what it has left to
+        send and close the connection.  Slow readers are cut off at once.
+        """
+        protocol = self.clients.get(client)
+        if protocol is None:
+            return
+        if protocol.paused:
+            ## Don't wait for a client that isn't reading to take the rest
+            protocol.transport.abort()
+        else:
+            protocol.flush()
+            protocol.transport.close()
+
+    def _note_send_pending(self, client):
+        """
+        Called by a client when its send_pending flag flips, schedule a
+        write to the transport.
+        """
+        protocol = self.clients.get(client)
+        if protocol is not None and client.send_pending:
+            self.loop.call_soon(protocol.flush)